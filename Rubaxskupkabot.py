@@ -1,439 +1,885 @@
-import os
-import json
-import random
-import string
-import logging
-import asyncio
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
-
-from aiogram import Bot, Dispatcher, Router, F
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
-from aiogram.filters import CommandStart, Command
-from aiogram.fsm.context import FSMContext
-from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
-
-# ========== Конфигурация ==========
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_ID = os.getenv("ADMIN_ID")
-
-if not BOT_TOKEN or not ADMIN_ID:
-    raise ValueError("Не заданы переменные окружения BOT_TOKEN или ADMIN_ID")
-
-try:
-    ADMIN_ID = int(ADMIN_ID)
-except ValueError:
-    raise ValueError("ADMIN_ID должен быть числом")
-
-# ========== Работа с пользователями (JSON) ==========
-USERS_FILE = "users.json"
-
-def load_users() -> Dict[int, Dict[str, Any]]:
-    """Загружает список пользователей из JSON-файла."""
-    if os.path.exists(USERS_FILE):
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            # Преобразуем ключи в int
-            return {int(k): v for k, v in data.items()}
-    return {}
-
-def save_users(users: Dict[int, Dict[str, Any]]):
-    """Сохраняет список пользователей в JSON-файл."""
-    with open(USERS_FILE, "w", encoding="utf-8") as f:
-        json.dump(users, f, ensure_ascii=False, indent=2)
-
-def add_user(user_id: int, username: str = None, first_name: str = None):
-    """Добавляет или обновляет информацию о пользователе."""
-    users = load_users()
-    if user_id not in users:
-        users[user_id] = {
-            "id": user_id,
-            "username": username,
-            "first_name": first_name,
-            "first_seen": datetime.now().isoformat()
-        }
-    else:
-        # Обновляем имя/юзернейм, если они изменились
-        if username:
-            users[user_id]["username"] = username
-        if first_name:
-            users[user_id]["first_name"] = first_name
-    save_users(users)
-
-def get_user_by_username(username: str) -> Optional[int]:
-    """Возвращает ID пользователя по username (без @)."""
-    users = load_users()
-    username = username.lower().lstrip('@')
-    for uid, data in users.items():
-        if data.get("username") and data["username"].lower() == username:
-            return uid
-    return None
-
-def get_all_users() -> list[int]:
-    """Возвращает список всех ID пользователей."""
-    return list(load_users().keys())
-
-# ========== Хранилище времени последней заявки ==========
-user_last_request: Dict[int, datetime] = {}
-
-def can_send_request(user_id: int) -> tuple[bool, str]:
-    """Проверяет, можно ли отправить заявку (не чаще 1 раза в 3 часа)"""
-    if user_id not in user_last_request:
-        return True, ""
-
-    last_time = user_last_request[user_id]
-    delta = datetime.now() - last_time
-    # ИЗМЕНЕНО: 6 -> 3 часа
-    if delta >= timedelta(hours=3):
-        return True, ""
-    else:
-        remaining = timedelta(hours=3) - delta
-        hours, remainder = divmod(remaining.seconds, 3600)
-        minutes, _ = divmod(remainder, 60)
-        return False, f"⏳ Вы уже отправляли заявку. Попробуйте снова через {hours} ч. {minutes} мин."
-
-def update_last_request(user_id: int):
-    """Обновляет время последней заявки"""
-    user_last_request[user_id] = datetime.now()
-
-def generate_lot_number() -> str:
-    """Генерирует номер лота: # + 6 символов (заглавные буквы+цифры)"""
-    return '#' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-
-# ========== Клавиатуры ==========
-# ИЗМЕНЕНО: создаём две клавиатуры — для обычных пользователей и для админа
-user_keyboard = ReplyKeyboardMarkup(
-    keyboard=[[KeyboardButton(text="📢 ПРОДАТЬ РОБУКСЫ")]],
-    resize_keyboard=True
-)
-
-admin_keyboard = ReplyKeyboardMarkup(
-    keyboard=[[]],  # пустая клавиатура (можно добавить кнопки для команд, если нужно)
-    resize_keyboard=True
-)
-
-# ========== Состояния FSM ==========
-class SellRobux(StatesGroup):
-    waiting_for_amount = State()
-
-class AdminStates(StatesGroup):
-    waiting_for_broadcast = State()   # ожидание сообщения для рассылки
-
-# ========== Глобальное состояние активного чата админа ==========
-# Для одного админа храним ID пользователя, с которым идёт диалог (или None)
-active_admin_chat: Optional[int] = None
-
-# ========== Роутер и обработчики ==========
-router = Router()
-
-# ----- Вспомогательные функции для проверки админа -----
-def is_admin(user_id: int) -> bool:
-    return user_id == ADMIN_ID
-
-# ----- Обработчик команды /start -----
-@router.message(CommandStart())
-async def cmd_start(message: Message):
-    """Приветственное сообщение с информацией и кнопкой"""
-    user = message.from_user
-    add_user(user.id, user.username, user.first_name)
-
-    # ИЗМЕНЕНО: разная клавиатура для админа и пользователя
-    keyboard = admin_keyboard if is_admin(user.id) else user_keyboard
-
-    text = (
-        "👋 Привет! Меня зовут Kotonaft15.\n"
-        "Я продавец на FunPay и готов помочь вам обналичить игровую валюту в реальные деньги.\n\n"
-        "💰 Курс: 1 Robux = 0.3 руб\n"
-        "📦 Минимум: от 10 Robux\n"
-        "⚖️ Комиссия игры (30%) лежит на вас.\n"
-        "🛡 Гарант: FunPay (предпочтительно) или без гаранта (напрямую с вами, но первый не иду).\n"
-        "⏳ Передача: через Game Pass (5 дней ожидания).\n\n"
-        "Если хотите продать Robux, нажмите кнопку ниже 👇"
-    )
-    await message.answer(text, reply_markup=keyboard)
-
-# ----- Обработчик кнопки "ПРОДАТЬ РОБУКСЫ" -----
-@router.message(F.text == "📢 ПРОДАТЬ РОБУКСЫ")
-async def sell_button(message: Message, state: FSMContext):
-    """Нажатие кнопки — начало процесса продажи"""
-    user = message.from_user
-    add_user(user.id, user.username, user.first_name)
-
-    # ИЗМЕНЕНО: админ не может продавать
-    if is_admin(user.id):
-        await message.answer("❌ Эта функция доступна только покупателям.")
-        return
-
-    await message.answer("Введите количество Robux, которое вы готовы продать (минимум 10):")
-    await state.set_state(SellRobux.waiting_for_amount)
-
-# ----- Обработчик ввода количества Robux -----
-@router.message(SellRobux.waiting_for_amount)
-async def process_amount(message: Message, state: FSMContext):
-    """Обработка введённого количества"""
-    user_id = message.from_user.id
-    user = message.from_user
-    add_user(user.id, user.username, user.first_name)
-
-    # Проверка на число
-    try:
-        amount = int(message.text)
-    except ValueError:
-        await message.answer("❌ Пожалуйста, введите целое число.")
-        return
-
-    # Проверка минимальной суммы
-    if amount < 10:
-        await message.answer("❌ Минимальная сумма — 10 Robux. Попробуйте ещё раз.")
-        return
-
-    # Проверка временного ограничения
-    can_send, limit_msg = can_send_request(user_id)
-    if not can_send:
-        await message.answer(limit_msg)
-        await state.clear()
-        return
-
-    # Генерация номера лота
-    lot = generate_lot_number()
-
-    # Расчёты
-    after_commission = int(amount * 0.7)               # за вычетом 30% комиссии игры
-    price_fp = after_commission * 0.37                  # через FunPay
-    price_direct = after_commission * 0.30               # напрямую
-
-    # Сообщение пользователю
-    await message.answer(
-        f"✅ Лот {lot} создан и отправлен администратору.\n"
-        f"Ожидайте, скоро с вами свяжутся.",
-        parse_mode="Markdown"
-    )
-
-    # Сообщение администратору
-    user_link = f"@{user.username}" if user.username else f"<a href='tg://user?id={user.id}'>пользователь</a>"
-
-    admin_text = (
-        f"📦 Лот: {lot}\n"
-        f"Количество: {amount} Robux\n"
-        f"С вычетом комиссии (30%): {after_commission} Robux\n"
-        f"Сумма оплаты:\n"
-        f"💰 Цена с учётом комиссии FP: {price_fp:.2f} руб\n"
-        f"💸 Цена напрямую: {price_direct:.2f} руб\n"
-        f"👤 Связь с пользователем: {user_link}"
-    )
-
-    await message.bot.send_message(ADMIN_ID, admin_text, parse_mode="HTML")
-
-    # Обновляем время последней заявки
-    update_last_request(user_id)
-
-    # Завершаем состояние
-    await state.clear()
-
-# ----- Обработчик команды /cancel (для выхода из состояний) -----
-@router.message(Command("cancel"))
-async def cmd_cancel(message: Message, state: FSMContext):
-    """Отмена текущего действия"""
-    if await state.get_state() is not None:
-        await state.clear()
-        await message.answer("❌ Действие отменено.")
-    else:
-        await message.answer("❌ Нет активного действия для отмены.")
-
-# ----- Обработчик команд администратора -----
-@router.message(Command("all"))
-async def cmd_broadcast(message: Message, state: FSMContext):
-    """Начало рассылки всем пользователям (только для админа)"""
-    if not is_admin(message.from_user.id):
-        return
-
-    await message.answer(
-        "Отправьте сообщение (текст, фото, видео, документ и т.п.) для рассылки всем пользователям.\n"
-        "Или отправьте /cancel для отмены."
-    )
-    await state.set_state(AdminStates.waiting_for_broadcast)
-
-@router.message(AdminStates.waiting_for_broadcast)
-async def process_broadcast(message: Message, state: FSMContext):
-    """Отправка полученного сообщения всем пользователям"""
-    if not is_admin(message.from_user.id):
-        await state.clear()
-        return
-
-    # ИЗМЕНЕНО: принимаем любое сообщение, копируем его
-    users = get_all_users()
-    if not users:
-        await message.answer("Список пользователей пуст.")
-        await state.clear()
-        return
-
-    await message.answer(f"Начинаю рассылку {len(users)} пользователям...")
-
-    success = 0
-    failed = 0
-    for uid in users:
-        try:
-            # Копируем сообщение (сохраняет тип, подпись, медиа)
-            await message.copy_to(uid)
-            success += 1
-            await asyncio.sleep(0.05)  # небольшая задержка
-        except TelegramForbiddenError:
-            failed += 1
-        except TelegramRetryAfter as e:
-            await asyncio.sleep(e.retry_after)
-            try:
-                await message.copy_to(uid)
-                success += 1
-            except:
-                failed += 1
-        except Exception:
-            failed += 1
-
-    await message.answer(f"✅ Рассылка завершена.\nУспешно: {success}\nНе удалось: {failed}")
-    await state.clear()
-
-@router.message(Command("chat"))
-async def cmd_chat(message: Message):
-    """Начать диалог с пользователем (только для админа)"""
-    if not is_admin(message.from_user.id):
-        return
-
-    global active_admin_chat
-
-    # Если уже есть активный чат, предложим завершить его сначала
-    if active_admin_chat is not None:
-        await message.answer("⚠️ У вас уже есть активный чат. Сначала завершите его командой /end.")
-        return
-
-    args = message.text.split(maxsplit=1)
-    if len(args) < 2:
-        await message.answer("Укажите пользователя: /chat <username или id>")
-        return
-
-    target = args[1].strip()
-    user_id = None
-
-    # Пытаемся определить ID
-    if target.isdigit():
-        user_id = int(target)
-        # Проверим, есть ли такой пользователь в нашей БД
-        users = load_users()
-        if user_id not in users:
-            # Всё равно попробуем отправить сообщение, но если бот не может писать первым — не получится
-            pass
-    else:
-        # Поиск по username
-        user_id = get_user_by_username(target)
-        if user_id is None:
-            await message.answer("Пользователь с таким username не найден в базе.")
-            return
-
-    if user_id == ADMIN_ID:
-        await message.answer("Нельзя начать чат с самим собой.")
-        return
-
-    # Проверим, может ли бот отправить сообщение этому пользователю (т.е. есть ли диалог)
-    try:
-        # Отправляем служебное сообщение, чтобы инициировать диалог
-        await message.bot.send_message(
-            user_id,
-            "👤 Администратор начал с вами диалог. Теперь вы можете общаться через этого бота. Напишите ваше сообщение."
-        )
-    except Exception as e:
-        await message.answer(f"❌ Не удалось отправить сообщение пользователю. Возможно, он не начинал диалог с ботом. Ошибка: {e}")
-        return
-
-    # Всё хорошо, устанавливаем активный чат
-    active_admin_chat = user_id
-
-    # Получаем информацию о пользователе для красивого ответа админу
-    users = load_users()
-    user_info = users.get(user_id, {})
-    name = user_info.get("first_name") or user_info.get("username") or str(user_id)
-    await message.answer(f"✅ Чат с пользователем {name} (ID: {user_id}) начат. Все ваши следующие сообщения будут пересылаться ему. Для завершения используйте /end.")
-
-@router.message(Command("end"))
-async def cmd_end(message: Message):
-    """Завершить текущий диалог (только для админа)"""
-    if not is_admin(message.from_user.id):
-        return
-
-    global active_admin_chat
-    if active_admin_chat is None:
-        await message.answer("Нет активного чата.")
-        return
-
-    # Уведомляем пользователя о завершении
-    try:
-        await message.bot.send_message(
-            active_admin_chat,
-            "🔚 Администратор завершил диалог. Если у вас остались вопросы, вы можете снова отправить заявку через кнопку."
-        )
-    except Exception:
-        pass  # Если не удалось, ничего страшного
-
-    active_admin_chat = None
-    await message.answer("✅ Чат завершён.")
-
-# ----- Основной обработчик сообщений (пересылка, если активен чат) -----
-@router.message()
-async def handle_all_messages(message: Message, state: FSMContext):
-    """Обрабатывает все сообщения, не попавшие в другие хэндлеры."""
-    user_id = message.from_user.id
-    global active_admin_chat
-
-    # Добавляем пользователя в базу при любом сообщении (на всякий случай)
-    add_user(user_id, message.from_user.username, message.from_user.first_name)
-
-    # Сообщения от админа
-    if is_admin(user_id):
-        # Проверяем, не находится ли админ в состоянии ожидания ввода (например, рассылки)
-        current_state = await state.get_state()
-        if current_state is not None:
-            return  # состояние обработается в соответствующем хэндлере
-
-        # Если админ не в состоянии и есть активный чат, пересылаем сообщение пользователю
-        if active_admin_chat is not None:
-            try:
-                await message.copy_to(active_admin_chat)
-            except Exception as e:
-                await message.answer(f"❌ Не удалось отправить сообщение пользователю: {e}")
-                active_admin_chat = None
-                await message.answer("⚠️ Чат завершён из-за ошибки отправки.")
-        else:
-            # Нет активного чата — игнорируем обычные сообщения от админа
-            # (можно ничего не отвечать, чтобы не засорять)
-            pass
-        return
-
-    # Сообщения от обычного пользователя
-    if active_admin_chat == user_id:
-        try:
-            await message.copy_to(ADMIN_ID)
-        except Exception as e:
-            logging.error(f"Не удалось переслать сообщение админу: {e}")
-    else:
-        # Пользователь не в активном чате
-        if not message.text or not message.text.startswith('/'):
-            await message.answer("Используйте кнопку «📢 ПРОДАТЬ РОБУКСЫ» для создания заявки.")
-
-# ========== Точка входа ==========
-async def main():
-    # Настройка логирования
-    logging.basicConfig(level=logging.INFO)
-
-    # Инициализация бота и диспетчера
-    bot = Bot(token=BOT_TOKEN)
-    storage = MemoryStorage()
-    dp = Dispatcher(storage=storage)
-
-    # Подключаем роутер
-    dp.include_router(router)
-
-    # Запуск поллинга
-    await dp.start_polling(bot)
-
-if __name__ == "__main__":
-    asyncio.run(main())
+import os
+import random
+import string
+import logging
+import asyncio
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any
+
+from aiogram import Bot, Dispatcher, Router, F
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.filters import CommandStart, Command
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from audience import AUDIENCE_HELP, Audience, parse_audience
+from broadcast import BroadcastManager, PayloadCollector
+from fsm_storage import SqliteFSMStorage
+from lifecycle import Deadline, UpdateTracker, install_signal_handlers, load_snapshot, save_snapshot
+from metrics import metrics, MetricsMiddleware, RequestMetricsMiddleware, run_exporter
+from outbound import OutboundScheduler, Priority, outbound_priority
+from ratelimit import SlidingWindowLimiter, ThrottlingMiddleware
+from relay import RelaySessions
+from session import TunedSession
+from storage import SqliteStorage, create_storage, migrate_lots_jsonl, migrate_users_json
+from webhook import run_webhook
+
+# ========== Конфигурация ==========
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+ADMIN_ID = os.getenv("ADMIN_ID")
+
+if not BOT_TOKEN or not ADMIN_ID:
+    raise ValueError("Не заданы переменные окружения BOT_TOKEN или ADMIN_ID")
+
+try:
+    ADMIN_ID = int(ADMIN_ID)
+except ValueError:
+    raise ValueError("ADMIN_ID должен быть числом")
+
+# Адрес сервера Bot API; по умолчанию — api.telegram.org
+BOT_API_SERVER = os.getenv("BOT_API_SERVER")
+
+# Пул HTTP-соединений к Bot API: всего соединений, на один хост (0 — без ограничения),
+# сколько секунд держать свободное соединение и кэшировать DNS
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "0"))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "30"))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))
+# Таймаут запроса по умолчанию (загрузка медиа — дольше, см. session.METHOD_TIMEOUTS)
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "20"))
+# Повторы при 5xx, сетевых ошибках и retry_after
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный адрес бота; если задан, webhook регистрируется в Telegram при старте
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет заголовка X-Telegram-Bot-Api-Secret-Token; обязателен в режиме webhook
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("PORT", "8080"))
+# Сколько обновлений обрабатывается одновременно в режиме webhook
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "50"))
+
+# Экспорт метрик в формате Prometheus: в файл и/или по HTTP (по умолчанию выключен)
+METRICS_FILE = os.getenv("METRICS_FILE")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "15"))
+
+if BOT_MODE not in ("polling", "webhook"):
+    raise ValueError("BOT_MODE должен быть polling или webhook")
+
+# Без секрета публичный webhook принял бы поддельное обновление от имени админа
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    raise ValueError("В режиме webhook нужно задать WEBHOOK_SECRET")
+
+# ========== Хранилище пользователей и заявок ==========
+USERS_FILE = "users.json"
+# Бэкенд хранилища: json (users.json в памяти) или sqlite
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bot.db")
+# Как часто (в секундах) накопленные изменения users.json сбрасываются на диск
+USERS_FLUSH_INTERVAL = float(os.getenv("USERS_FLUSH_INTERVAL", "5"))
+# Хранилище состояний FSM: sqlite (переживает перезапуск) или memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_SQLITE_PATH = os.getenv("FSM_SQLITE_PATH", "fsm.db")
+# Через сколько секунд брошенный сценарий (продажа, рассылка) сбрасывается
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", "86400"))
+
+# Журнал лотов для JSON-бэкенда (в SQLite лоты лежат в таблице lots)
+LOTS_FILE = os.getenv("LOTS_FILE", "lots.jsonl")
+# Сколько последних лотов показывать в /lots
+LOTS_PAGE_SIZE = 20
+
+# Бинарный снимок users.json для быстрого старта (пишется при остановке)
+USERS_SNAPSHOT = os.getenv("USERS_SNAPSHOT", "users.pickle")
+
+storage = create_storage(STORAGE_BACKEND, USERS_FILE, SQLITE_PATH, USERS_FLUSH_INTERVAL, LOTS_FILE, USERS_SNAPSHOT)
+
+@metrics.timed("storage", "add_user")
+async def add_user(user_id: int, username: str = None, first_name: str = None):
+    """Добавляет или обновляет информацию о пользователе."""
+    await storage.add_user(user_id, username, first_name)
+
+@metrics.timed("storage", "get_user")
+async def get_user(user_id: int) -> Optional[Dict[str, Any]]:
+    """Возвращает запись пользователя по ID (или None)."""
+    return await storage.get_user(user_id)
+
+@metrics.timed("storage", "get_user_by_username")
+async def get_user_by_username(username: str) -> Optional[int]:
+    """Возвращает ID пользователя по username (без @)."""
+    return await storage.get_user_by_username(username)
+
+@metrics.timed("storage", "get_all_users")
+async def get_all_users() -> list[int]:
+    """Возвращает список всех ID пользователей."""
+    return await storage.get_all_users()
+
+@metrics.timed("storage", "select_users")
+async def select_users(audience: Audience) -> list[int]:
+    """ID пользователей, подходящих под фильтры рассылки."""
+    return await storage.select_users(audience)
+
+@metrics.timed("storage", "count_audience")
+async def count_audience(audience: Audience) -> int:
+    """Число пользователей, подходящих под фильтры рассылки."""
+    return await storage.count_audience(audience)
+
+# ========== Ограничение частоты заявок ==========
+@metrics.timed("storage", "can_send_request")
+async def can_send_request(user_id: int) -> tuple[bool, str]:
+    """Проверяет, можно ли отправить заявку (не чаще 1 раза в 3 часа)"""
+    last_time = await storage.get_last_request(user_id)
+    if last_time is None:
+        return True, ""
+
+    delta = datetime.now() - last_time
+    # ИЗМЕНЕНО: 6 -> 3 часа
+    if delta >= timedelta(hours=3):
+        return True, ""
+    else:
+        remaining = timedelta(hours=3) - delta
+        hours, remainder = divmod(remaining.seconds, 3600)
+        minutes, _ = divmod(remainder, 60)
+        return False, f"⏳ Вы уже отправляли заявку. Попробуйте снова через {hours} ч. {minutes} мин."
+
+@metrics.timed("storage", "update_last_request")
+async def update_last_request(user_id: int):
+    """Обновляет время последней заявки"""
+    await storage.set_last_request(user_id, datetime.now())
+
+def generate_lot_number() -> str:
+    """Генерирует номер лота: # + 6 символов (заглавные буквы+цифры)"""
+    return '#' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+
+# ========== Журнал лотов ==========
+@metrics.timed("storage", "create_lot")
+async def create_lot(user, amount: int, after_commission: int, price_fp: float, price_direct: float) -> Dict[str, Any]:
+    """Записывает лот в журнал под новым номером. Номер гарантированно уникален."""
+    while True:
+        lot = {
+            "lot": generate_lot_number(),
+            "user_id": user.id,
+            "username": user.username,
+            "amount": amount,
+            "after_commission": after_commission,
+            "price_fp": round(price_fp, 2),
+            "price_direct": round(price_direct, 2),
+            "created": datetime.now().isoformat(timespec="seconds"),
+        }
+        # Номер занят — пробуем другой (из 36^6 вариантов повтор крайне редок)
+        if await storage.add_lot(lot):
+            return lot
+
+@metrics.timed("storage", "get_lot")
+async def get_lot(number: str) -> Optional[Dict[str, Any]]:
+    """Лот по номеру (или None)."""
+    return await storage.get_lot(number)
+
+@metrics.timed("storage", "get_user_lots")
+async def get_user_lots(user_id: int, limit: int) -> tuple[list[Dict[str, Any]], int]:
+    """Последние limit лотов пользователя (новые первыми) и их общее число."""
+    return await storage.get_user_lots(user_id, limit)
+
+def format_lot(lot: Dict[str, Any], with_date: bool = False) -> str:
+    """Карточка лота для админа (HTML)."""
+    if lot.get("username"):
+        user_link = f"@{lot['username']}"
+    else:
+        user_link = f"<a href='tg://user?id={lot['user_id']}'>пользователь</a>"
+
+    text = f"📦 Лот: {lot['lot']}\n"
+    if with_date:
+        text += f"🕒 Создан: {datetime.fromisoformat(lot['created']):%d.%m.%Y %H:%M}\n"
+    return text + (
+        f"Количество: {lot['amount']} Robux\n"
+        f"С вычетом комиссии (30%): {lot['after_commission']} Robux\n"
+        f"Сумма оплаты:\n"
+        f"💰 Цена с учётом комиссии FP: {lot['price_fp']:.2f} руб\n"
+        f"💸 Цена напрямую: {lot['price_direct']:.2f} руб\n"
+        f"👤 Связь с пользователем: {user_link}"
+    )
+
+# ========== Исходящие сообщения ==========
+# Общий бюджет запросов к Bot API (в секунду) — чуть ниже лимита Telegram в ~30
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", "28"))
+# Бюджет на один чат: в среднем сообщение в секунду, короткие всплески до трёх
+OUTBOUND_PER_CHAT_RATE = float(os.getenv("OUTBOUND_PER_CHAT_RATE", "1"))
+OUTBOUND_PER_CHAT_BURST = float(os.getenv("OUTBOUND_PER_CHAT_BURST", "3"))
+
+outbound = OutboundScheduler(
+    rate=OUTBOUND_RATE,
+    per_chat_rate=OUTBOUND_PER_CHAT_RATE,
+    per_chat_burst=OUTBOUND_PER_CHAT_BURST,
+)
+
+# ========== Рассылка ==========
+# Сколько сообщений рассылки отправляется параллельно
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "20"))
+# Каталог журналов рассылок (для продолжения после перезапуска)
+BROADCASTS_DIR = os.getenv("BROADCASTS_DIR", "broadcasts")
+# Сообщения админа с паузой меньше этой (сек.) и части альбома — одна рассылка
+BROADCAST_COLLECT_DELAY = float(os.getenv("BROADCAST_COLLECT_DELAY", "1.5"))
+
+async def mark_user_blocked(user_id: int):
+    """Пользователь заблокировал бота — исключаем его из следующих рассылок."""
+    await storage.set_user_active(user_id, False)
+
+broadcasts = BroadcastManager(
+    workers=BROADCAST_WORKERS,
+    journal_dir=BROADCASTS_DIR,
+    on_blocked=mark_user_blocked,
+)
+
+broadcast_payloads = PayloadCollector(delay=BROADCAST_COLLECT_DELAY)
+
+# ========== Клавиатуры ==========
+# ИЗМЕНЕНО: создаём две клавиатуры — для обычных пользователей и для админа
+user_keyboard = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="📢 ПРОДАТЬ РОБУКСЫ")]],
+    resize_keyboard=True
+)
+
+admin_keyboard = ReplyKeyboardMarkup(
+    keyboard=[[]],  # пустая клавиатура (можно добавить кнопки для команд, если нужно)
+    resize_keyboard=True
+)
+
+# ========== Состояния FSM ==========
+class SellRobux(StatesGroup):
+    waiting_for_amount = State()
+
+class AdminStates(StatesGroup):
+    waiting_for_broadcast = State()   # ожидание сообщения для рассылки
+
+# ========== Диалоги админа с пользователями ==========
+# Сколько последних сообщений в чате админа помнить для маршрутизации ответов
+RELAY_LINKS_LIMIT = int(os.getenv("RELAY_LINKS_LIMIT", "10000"))
+
+relay = RelaySessions(max_links=RELAY_LINKS_LIMIT)
+
+# ========== Анти-флуд ==========
+# Не более THROTTLE_LIMIT сообщений от пользователя за THROTTLE_WINDOW секунд
+THROTTLE_LIMIT = int(os.getenv("THROTTLE_LIMIT", "5"))
+THROTTLE_WINDOW = float(os.getenv("THROTTLE_WINDOW", "5"))
+
+message_limiter = SlidingWindowLimiter(limit=THROTTLE_LIMIT, window=THROTTLE_WINDOW)
+
+# ========== Роутер и обработчики ==========
+router = Router()
+# Метрики: время обработки всех сообщений (включая отброшенные) и каждого обработчика
+router.message.outer_middleware(MetricsMiddleware())
+router.message.middleware(MetricsMiddleware(per_handler=True))
+# Флуд отсекается до любых обработчиков; админа не ограничиваем
+router.message.outer_middleware(ThrottlingMiddleware(message_limiter, exempt=[ADMIN_ID]))
+
+metrics.gauge("broadcasts_running", lambda: len(broadcasts.running))
+metrics.gauge("relay_sessions", lambda: len(relay.sessions))
+metrics.gauge("throttle_tracked_users", lambda: len(message_limiter))
+
+# ----- Вспомогательные функции для проверки админа -----
+def is_admin(user_id: int) -> bool:
+    return user_id == ADMIN_ID
+
+async def resolve_user(target: str) -> Optional[int]:
+    """Определяет ID пользователя по строке: числовой ID или username."""
+    if target.isdigit():
+        # Пользователя может не быть в нашей БД — всё равно попробуем написать ему
+        return int(target)
+    # Поиск по username
+    return await get_user_by_username(target)
+
+async def display_name(user_id: int) -> str:
+    """Имя пользователя для сообщений админу."""
+    user_info = await get_user(user_id) or {}
+    return user_info.get("first_name") or user_info.get("username") or str(user_id)
+
+# ----- Обработчик команды /start -----
+@router.message(CommandStart())
+async def cmd_start(message: Message):
+    """Приветственное сообщение с информацией и кнопкой"""
+    user = message.from_user
+    await add_user(user.id, user.username, user.first_name)
+
+    # ИЗМЕНЕНО: разная клавиатура для админа и пользователя
+    keyboard = admin_keyboard if is_admin(user.id) else user_keyboard
+
+    text = (
+        "👋 Привет! Меня зовут Kotonaft15.\n"
+        "Я продавец на FunPay и готов помочь вам обналичить игровую валюту в реальные деньги.\n\n"
+        "💰 Курс: 1 Robux = 0.3 руб\n"
+        "📦 Минимум: от 10 Robux\n"
+        "⚖️ Комиссия игры (30%) лежит на вас.\n"
+        "🛡 Гарант: FunPay (предпочтительно) или без гаранта (напрямую с вами, но первый не иду).\n"
+        "⏳ Передача: через Game Pass (5 дней ожидания).\n\n"
+        "Если хотите продать Robux, нажмите кнопку ниже 👇"
+    )
+    await message.answer(text, reply_markup=keyboard)
+
+# ----- Обработчик кнопки "ПРОДАТЬ РОБУКСЫ" -----
+@router.message(F.text == "📢 ПРОДАТЬ РОБУКСЫ")
+async def sell_button(message: Message, state: FSMContext):
+    """Нажатие кнопки — начало процесса продажи"""
+    user = message.from_user
+    await add_user(user.id, user.username, user.first_name)
+
+    # ИЗМЕНЕНО: админ не может продавать
+    if is_admin(user.id):
+        await message.answer("❌ Эта функция доступна только покупателям.")
+        return
+
+    await message.answer("Введите количество Robux, которое вы готовы продать (минимум 10):")
+    await state.set_state(SellRobux.waiting_for_amount)
+
+# ----- Обработчик ввода количества Robux -----
+@router.message(SellRobux.waiting_for_amount)
+async def process_amount(message: Message, state: FSMContext):
+    """Обработка введённого количества"""
+    user_id = message.from_user.id
+    user = message.from_user
+    await add_user(user.id, user.username, user.first_name)
+
+    # Проверка на число
+    try:
+        amount = int(message.text)
+    except ValueError:
+        await message.answer("❌ Пожалуйста, введите целое число.")
+        return
+
+    # Проверка минимальной суммы
+    if amount < 10:
+        await message.answer("❌ Минимальная сумма — 10 Robux. Попробуйте ещё раз.")
+        return
+
+    # Проверка временного ограничения
+    can_send, limit_msg = await can_send_request(user_id)
+    if not can_send:
+        await message.answer(limit_msg)
+        await state.clear()
+        return
+
+    # Расчёты
+    after_commission = int(amount * 0.7)               # за вычетом 30% комиссии игры
+    price_fp = after_commission * 0.37                  # через FunPay
+    price_direct = after_commission * 0.30               # напрямую
+
+    # Запись в журнал лотов (там же выдаётся уникальный номер)
+    lot = await create_lot(user, amount, after_commission, price_fp, price_direct)
+
+    # Сообщение пользователю
+    await message.answer(
+        f"✅ Лот {lot['lot']} создан и отправлен администратору.\n"
+        f"Ожидайте, скоро с вами свяжутся.",
+        parse_mode="Markdown"
+    )
+
+    # Сообщение администратору — после диалогов, но раньше рассылки
+    with outbound_priority(Priority.ADMIN):
+        await message.bot.send_message(ADMIN_ID, format_lot(lot), parse_mode="HTML")
+
+    # Обновляем время последней заявки
+    await update_last_request(user_id)
+
+    # Завершаем состояние
+    await state.clear()
+
+# ----- Обработчик команды /cancel (для выхода из состояний) -----
+@router.message(Command("cancel"))
+async def cmd_cancel(message: Message, state: FSMContext):
+    """Отмена текущего действия"""
+    if await state.get_state() is not None:
+        # Недособранная рассылка тоже отменяется
+        broadcast_payloads.cancel(message.chat.id)
+        await state.clear()
+        await message.answer("❌ Действие отменено.")
+    else:
+        await message.answer("❌ Нет активного действия для отмены.")
+
+# ----- Обработчик команд администратора -----
+@router.message(Command("all"))
+async def cmd_broadcast(message: Message, state: FSMContext):
+    """Начало рассылки (только для админа): /all [фильтры аудитории]"""
+    if not is_admin(message.from_user.id):
+        return
+
+    args = message.text.split(maxsplit=1)
+    try:
+        audience = parse_audience(args[1] if len(args) > 1 else "")
+    except ValueError as e:
+        await message.answer(f"❌ {e}\n\n{AUDIENCE_HELP}")
+        return
+
+    # Предпросмотр: сколько человек получит рассылку
+    count = await count_audience(audience)
+    if not count:
+        await message.answer(f"Под фильтр «{audience.describe()}» не подходит ни один пользователь.")
+        return
+
+    await message.answer(
+        f"👥 Аудитория: {audience.describe()} — {count} получателей.\n\n"
+        "Отправьте сообщение (текст, фото, видео, документ и т.п.) или альбом для рассылки — "
+        "несколько сообщений подряд уйдут одной рассылкой.\n"
+        "Или отправьте /cancel для отмены.\n\n"
+        f"{AUDIENCE_HELP}"
+    )
+    await state.set_state(AdminStates.waiting_for_broadcast)
+    await state.update_data(audience=audience.to_dict())
+
+@router.message(AdminStates.waiting_for_broadcast)
+async def process_broadcast(message: Message, state: FSMContext):
+    """Приём сообщений для рассылки: альбом или серия сообщений подряд — одна рассылка"""
+    if not is_admin(message.from_user.id):
+        await state.clear()
+        return
+
+    # ИЗМЕНЕНО: принимаем любые сообщения и копируем их; рассылка стартует после паузы
+    async def launch(message_ids: list[int]):
+        await start_broadcast(message, state, message_ids)
+
+    broadcast_payloads.add(message.chat.id, message.message_id, launch)
+
+async def start_broadcast(message: Message, state: FSMContext, message_ids: list[int]):
+    """Запускает рассылку собранных сообщений по аудитории, выбранной в /all"""
+    if await state.get_state() != AdminStates.waiting_for_broadcast.state:
+        return  # рассылку успели отменить
+
+    data = await state.get_data()
+    users = await select_users(Audience(**data.get("audience", {})))
+    await state.clear()
+    if not users:
+        await message.answer("Под фильтр не подходит ни один пользователь.")
+        return
+
+    # Рассылка идёт в фоне — админ может сразу продолжать работу
+    items = f" ({len(message_ids)} сообщ.)" if len(message_ids) > 1 else ""
+    status = await message.answer(f"Начинаю рассылку{items} {len(users)} пользователям...")
+    await broadcasts.start(
+        message.bot,
+        message.chat.id,
+        message_ids,
+        users,
+        status_chat_id=status.chat.id,
+        status_message_id=status.message_id,
+    )
+
+@router.message(Command("lot"))
+async def cmd_lot(message: Message):
+    """Поиск лота по номеру (только для админа)"""
+    if not is_admin(message.from_user.id):
+        return
+
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        await message.answer("Укажите номер лота: /lot #ABC123")
+        return
+
+    number = '#' + args[1].strip().lstrip('#').upper()
+    lot = await get_lot(number)
+    if lot is None:
+        await message.answer(f"Лот {number} не найден.")
+        return
+
+    await message.answer(format_lot(lot, with_date=True), parse_mode="HTML")
+
+@router.message(Command("lots"))
+async def cmd_lots(message: Message):
+    """Последние лоты пользователя (только для админа)"""
+    if not is_admin(message.from_user.id):
+        return
+
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        await message.answer("Укажите пользователя: /lots <username или id>")
+        return
+
+    user_id = await resolve_user(args[1].strip())
+    if user_id is None:
+        await message.answer("Пользователь с таким username не найден в базе.")
+        return
+
+    lots, total = await get_user_lots(user_id, limit=LOTS_PAGE_SIZE)
+    if not lots:
+        await message.answer(f"У пользователя {await display_name(user_id)} нет лотов.")
+        return
+
+    lines = [f"📦 Лоты {await display_name(user_id)} (ID: {user_id}), всего: {total}"]
+    for lot in lots:
+        lines.append(
+            f"• {lot['lot']} — {lot['amount']} Robux, "
+            f"{datetime.fromisoformat(lot['created']):%d.%m.%Y %H:%M}"
+        )
+    if total > len(lots):
+        lines.append(f"…показаны последние {len(lots)}")
+    await message.answer("\n".join(lines))
+
+@router.message(Command("stats"))
+async def cmd_stats(message: Message):
+    """Метрики бота (только для админа)"""
+    if not is_admin(message.from_user.id):
+        return
+
+    await message.answer(metrics.render_text())
+
+@router.message(Command("chat"))
+async def cmd_chat(message: Message):
+    """Начать диалог с пользователем (только для админа)"""
+    if not is_admin(message.from_user.id):
+        return
+
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        await message.answer("Укажите пользователя: /chat <username или id>")
+        return
+
+    target = args[1].strip()
+    user_id = await resolve_user(target)
+    if user_id is None:
+        await message.answer("Пользователь с таким username не найден в базе.")
+        return
+
+    if user_id == ADMIN_ID:
+        await message.answer("Нельзя начать чат с самим собой.")
+        return
+
+    name = await display_name(user_id)
+
+    # Диалог уже открыт — просто делаем его текущим
+    if relay.is_open(user_id):
+        relay.open(user_id)
+        reply = await message.answer(f"↪️ Текущий диалог: {name} (ID: {user_id}).")
+        relay.link(reply.message_id, user_id)
+        return
+
+    # Проверим, может ли бот отправить сообщение этому пользователю (т.е. есть ли диалог)
+    try:
+        # Отправляем служебное сообщение, чтобы инициировать диалог
+        await message.bot.send_message(
+            user_id,
+            "👤 Администратор начал с вами диалог. Теперь вы можете общаться через этого бота. Напишите ваше сообщение."
+        )
+    except Exception as e:
+        await message.answer(f"❌ Не удалось отправить сообщение пользователю. Возможно, он не начинал диалог с ботом. Ошибка: {e}")
+        return
+
+    # Всё хорошо, открываем диалог и делаем его текущим
+    relay.open(user_id)
+    reply = await message.answer(
+        f"✅ Чат с пользователем {name} (ID: {user_id}) начат. Все ваши следующие сообщения будут пересылаться ему.\n"
+        f"Чтобы ответить в другой открытый диалог, используйте «Ответить» на его сообщении. "
+        f"Список диалогов: /sessions. Для завершения используйте /end."
+    )
+    relay.link(reply.message_id, user_id)
+
+@router.message(Command("end"))
+async def cmd_end(message: Message):
+    """Завершить диалог (только для админа): текущий, указанный или тот, на чьё сообщение дан ответ"""
+    if not is_admin(message.from_user.id):
+        return
+
+    args = message.text.split(maxsplit=1)
+    if len(args) > 1:
+        user_id = await resolve_user(args[1].strip())
+    elif message.reply_to_message:
+        user_id = relay.resolve(message.reply_to_message.message_id)
+    else:
+        user_id = relay.current
+
+    if user_id is None or not relay.is_open(user_id):
+        await message.answer("Нет активного чата.")
+        return
+
+    # Уведомляем пользователя о завершении
+    try:
+        await message.bot.send_message(
+            user_id,
+            "🔚 Администратор завершил диалог. Если у вас остались вопросы, вы можете снова отправить заявку через кнопку."
+        )
+    except Exception:
+        pass  # Если не удалось, ничего страшного
+
+    relay.close(user_id)
+    text = f"✅ Чат с {await display_name(user_id)} завершён."
+    if relay.current is not None:
+        text += f"\nТекущий диалог: {await display_name(relay.current)}."
+    await message.answer(text)
+
+@router.message(Command("sessions"))
+async def cmd_sessions(message: Message):
+    """Список открытых диалогов (только для админа)"""
+    if not is_admin(message.from_user.id):
+        return
+
+    if not relay.sessions:
+        await message.answer("Нет открытых диалогов.")
+        return
+
+    lines = ["💬 Открытые диалоги:"]
+    for user_id, opened in relay.sessions.items():
+        mark = " ← текущий" if user_id == relay.current else ""
+        lines.append(f"• {await display_name(user_id)} (ID: {user_id}), с {opened:%H:%M}{mark}")
+    await message.answer("\n".join(lines))
+
+async def relay_to_admin(message: Message):
+    """Копирует сообщение пользователя админу и запоминает связь для ответа."""
+    user_id = message.from_user.id
+    bot = message.bot
+
+    # Подпись с отправителем — только когда собеседник сменился, чтобы не удваивать сообщения
+    if relay.last_sender != user_id:
+        header = await bot.send_message(ADMIN_ID, f"💬 {await display_name(user_id)} (ID: {user_id}):")
+        relay.link(header.message_id, user_id)
+        relay.last_sender = user_id
+
+    copied = await message.copy_to(ADMIN_ID)
+    relay.link(copied.message_id, user_id)
+
+# ----- Основной обработчик сообщений (пересылка, если активен чат) -----
+@router.message()
+async def handle_all_messages(message: Message, state: FSMContext):
+    """Обрабатывает все сообщения, не попавшие в другие хэндлеры."""
+    user_id = message.from_user.id
+
+    # Добавляем пользователя в базу при любом сообщении (на всякий случай)
+    await add_user(user_id, message.from_user.username, message.from_user.first_name)
+
+    # Сообщения от админа
+    if is_admin(user_id):
+        # Проверяем, не находится ли админ в состоянии ожидания ввода (например, рассылки)
+        current_state = await state.get_state()
+        if current_state is not None:
+            return  # состояние обработается в соответствующем хэндлере
+
+        # Ответ на сообщение пользователя уходит ему, остальные — в текущий диалог
+        target = None
+        if message.reply_to_message:
+            target = relay.resolve(message.reply_to_message.message_id)
+        if target is None:
+            target = relay.current
+
+        if target is None:
+            # Нет активного чата — игнорируем обычные сообщения от админа
+            # (можно ничего не отвечать, чтобы не засорять)
+            return
+
+        if not relay.is_open(target):
+            await message.answer("⚠️ Диалог с этим пользователем уже завершён. Откройте его снова: /chat.")
+            return
+
+        try:
+            await message.copy_to(target)
+        except Exception as e:
+            await message.answer(f"❌ Не удалось отправить сообщение пользователю: {e}")
+            relay.close(target)
+            await message.answer("⚠️ Чат завершён из-за ошибки отправки.")
+        return
+
+    # Сообщения от обычного пользователя
+    if relay.is_open(user_id):
+        try:
+            await relay_to_admin(message)
+        except Exception as e:
+            logging.error(f"Не удалось переслать сообщение админу: {e}")
+    else:
+        # Пользователь не в активном чате
+        if not message.text or not message.text.startswith('/'):
+            await message.answer("Используйте кнопку «📢 ПРОДАТЬ РОБУКСЫ» для создания заявки.")
+
+# ========== Плавная остановка ==========
+# Сколько секунд после SIGTERM даётся на доработку обработчиков и рассылок
+# (платформа добивает процесс через ~30 с)
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "25"))
+# Снимок состояния из памяти (диалоги админа, анти-флуд) для тёплого перезапуска
+STATE_SNAPSHOT = os.getenv("STATE_SNAPSHOT", "state.pickle")
+
+update_tracker = UpdateTracker()
+metrics.gauge("updates_in_flight", lambda: update_tracker.in_flight)
+
+stop_requested = asyncio.Event()
+# Срок остановки отсчитывается от момента запроса остановки
+shutdown_deadline = Deadline(SHUTDOWN_TIMEOUT)
+
+def request_stop():
+    """Запрашивает плавную остановку (сигналом или при падении приёма обновлений)."""
+    global shutdown_deadline
+    if not stop_requested.is_set():
+        shutdown_deadline = Deadline(SHUTDOWN_TIMEOUT)
+        stop_requested.set()
+
+async def drain_updates():
+    """Хук остановки диспетчера: дорабатывает принятые обновления, пока FSM ещё открыто."""
+    if not await update_tracker.drain(shutdown_deadline.remaining()):
+        logging.warning(f"Остановка: не дождались {update_tracker.in_flight} обработчиков")
+
+async def confirm_updates(bot: Bot):
+    """Подтверждает Telegram обработанные обновления — после перезапуска они не придут снова."""
+    if update_tracker.in_flight or update_tracker.last_update_id is None:
+        return
+    try:
+        await bot.get_updates(offset=update_tracker.last_update_id + 1, limit=1, timeout=0)
+    except Exception as e:
+        logging.warning(f"Не удалось подтвердить обновления: {e}")
+
+def save_state():
+    """Сохраняет состояние из памяти в снимок."""
+    try:
+        save_snapshot(STATE_SNAPSHOT, {
+            "relay": relay.snapshot(),
+            "throttle": message_limiter.snapshot(),
+        })
+    except Exception as e:
+        logging.error(f"Не удалось сохранить снимок {STATE_SNAPSHOT}: {e}")
+
+def restore_state():
+    """Восстанавливает состояние из снимка, сохранённого при прошлой остановке."""
+    state = load_snapshot(STATE_SNAPSHOT)
+    if state is None:
+        return
+    relay.restore(state["relay"])
+    message_limiter.restore(state["throttle"])
+    # Снимок одноразовый: после аварийного падения не восстановим устаревшее состояние
+    os.remove(STATE_SNAPSHOT)
+    logging.info(f"Состояние восстановлено из снимка: диалогов {len(relay.sessions)}")
+
+# ========== Сборка бота и запуск сервисов ==========
+def create_bot() -> Bot:
+    """Создаёт бота с пулом соединений, очередью исходящих запросов и метриками."""
+    extra = {}
+    if BOT_API_SERVER:
+        # Свой сервер Bot API (локальный telegram-bot-api или тестовый)
+        extra["api"] = TelegramAPIServer.from_base(BOT_API_SERVER)
+    session = TunedSession(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE,
+        dns_ttl=HTTP_DNS_TTL,
+        timeout=HTTP_TIMEOUT,
+        max_retries=HTTP_MAX_RETRIES,
+        # retry_after запросов к чатам обрабатывает очередь: она приостанавливает чат и рассылку
+        defer_retry_after=outbound.handles,
+        **extra,
+    )
+    bot = Bot(token=BOT_TOKEN, session=session)
+    # Все исходящие запросы — через общую очередь с приоритетами
+    bot.session.middleware(outbound)
+    # Замер задержек и retry_after для всех вызовов Bot API (без учёта ожидания в очереди)
+    bot.session.middleware(RequestMetricsMiddleware())
+    return bot
+
+def create_dispatcher() -> Dispatcher:
+    """Создаёт диспетчер с хранилищем состояний FSM и роутером бота."""
+    if FSM_STORAGE == "memory":
+        fsm_storage = MemoryStorage()
+    else:
+        fsm_storage = SqliteFSMStorage(FSM_SQLITE_PATH, ttl=FSM_STATE_TTL)
+    dp = Dispatcher(storage=fsm_storage)
+    # Учёт обновлений в обработке; при остановке они дорабатываются раньше,
+    # чем диспетчер закроет хранилище FSM (его хук остановки зарегистрирован первым)
+    dp.update.outer_middleware(update_tracker)
+    dp.shutdown.handlers.insert(0, HandlerObject(callback=drain_updates))
+
+    # Подключаем роутер
+    dp.include_router(router)
+    return dp
+
+# Фоновые задачи сервисов (экспорт метрик и т.п.)
+service_tasks: list[asyncio.Task] = []
+
+async def start_services(bot: Bot):
+    """Открывает хранилище и запускает фоновые задачи перед приёмом обновлений."""
+    # Открываем хранилище (для JSON — чтение файла и запуск отложенной записи)
+    await storage.open()
+
+    # Первый запуск на SQLite: переносим существующие users.json и журнал лотов
+    # (лоты — после пользователей: по ним заполняется last_lot)
+    if isinstance(storage, SqliteStorage):
+        if os.path.exists(USERS_FILE) and not await storage.count_users():
+            count = await migrate_users_json(USERS_FILE, storage)
+            logging.info(f"Перенесено пользователей из {USERS_FILE} в SQLite: {count}")
+        if os.path.exists(LOTS_FILE) and not await storage.count_lots():
+            count = await migrate_lots_jsonl(LOTS_FILE, storage)
+            logging.info(f"Перенесено лотов из {LOTS_FILE} в SQLite: {count}")
+
+    # Продолжаем рассылки, прерванные перезапуском
+    broadcasts.resume(bot)
+
+    if METRICS_FILE or METRICS_PORT:
+        service_tasks.append(asyncio.create_task(
+            run_exporter(metrics, path=METRICS_FILE, port=METRICS_PORT, interval=METRICS_INTERVAL)
+        ))
+
+async def stop_services():
+    """Останавливает фоновые задачи и сохраняет данные."""
+    for task in service_tasks:
+        task.cancel()
+    service_tasks.clear()
+    await outbound.close()
+    # Финальное сохранение данных при остановке
+    await storage.close()
+
+# ========== Точка входа ==========
+async def main():
+    # Настройка логирования
+    logging.basicConfig(level=logging.INFO)
+
+    # Инициализация бота и диспетчера
+    bot = create_bot()
+    dp = create_dispatcher()
+
+    restore_state()
+    await start_services(bot)
+    # SIGTERM при деплое — плавная остановка вместо обрыва обработчиков
+    install_signal_handlers(request_stop)
+
+    if BOT_MODE == "webhook":
+        serving = asyncio.create_task(run_webhook(
+            dp,
+            bot,
+            host=WEBAPP_HOST,
+            port=WEBAPP_PORT,
+            path=WEBHOOK_PATH,
+            secret=WEBHOOK_SECRET,
+            base_url=WEBHOOK_URL,
+            max_concurrency=WEBHOOK_MAX_CONCURRENCY,
+            drain_timeout=SHUTDOWN_TIMEOUT,
+        ))
+    else:
+        # Бот мог раньше работать через webhook — тогда поллинг не получит обновлений
+        await bot.delete_webhook()
+        # Запуск поллинга; сигналы и закрытие сессии — на нашей стороне
+        serving = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+
+    stopping = asyncio.create_task(stop_requested.wait())
+    try:
+        await asyncio.wait({serving, stopping}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        request_stop()
+        stopping.cancel()
+        # 1. Перестаём принимать обновления и дорабатываем принятые
+        if not serving.done():
+            if BOT_MODE == "webhook":
+                serving.cancel()
+            else:
+                try:
+                    await dp.stop_polling()
+                except RuntimeError:
+                    serving.cancel()  # поллинг ещё не успел запуститься
+        result = (await asyncio.gather(serving, return_exceptions=True))[0]
+        # 2. Рассылки: даём доработать в пределах срока, остальное продолжится после запуска
+        await broadcasts.stop(shutdown_deadline.remaining())
+        # 3. Подтверждаем обработанные обновления и сохраняем состояние
+        if BOT_MODE != "webhook":
+            await confirm_updates(bot)
+        save_state()
+        await stop_services()
+        await bot.session.close()
+        # Ошибка приёма обновлений (занятый порт, неверный токен) — ненулевой код выхода
+        if isinstance(result, Exception):
+            raise result
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,183 @@
+from dataclasses import dataclass, asdict
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, Collection
+
+# ========== Аудитории рассылок ==========
+# Audience — фильтр получателей /all: давность прихода, последней активности,
+# наличие лотов и статус (активен / заблокировал бота). Хранилища отвечают на
+# него по индексам: SQLite — по индексам таблицы users, JSON-бэкенд — по
+# AudienceIndex, где пользователи разложены по дням, так что выборка «за
+# последние N дней» объединяет готовые корзины этих дней, а не перебирает всю базу.
+
+# Справка по фильтрам для админа
+AUDIENCE_HELP = (
+    "Фильтры (можно сочетать):\n"
+    "new=N — пришли за последние N дней\n"
+    "seen=N — писали боту за последние N дней\n"
+    "sellers — создавали лоты, sellers=N — за последние N дней\n"
+    "nolots — ни разу не создавали лот\n"
+    "blocked — только заблокировавшие бота, any — независимо от статуса"
+)
+
+
+@dataclass
+class Audience:
+    status: str = "active"              # active, blocked или any
+    new_days: Optional[int] = None      # first_seen за последние N дней
+    seen_days: Optional[int] = None     # последняя активность за N дней
+    lots: Optional[bool] = None         # True — с лотами, False — без лотов
+    lots_days: Optional[int] = None     # последний лот за N дней (при lots=True)
+
+    @staticmethod
+    def cutoff(days: int) -> str:
+        """Граница «последних N дней» в формате дат хранилища (isoformat)."""
+        return (datetime.now() - timedelta(days=days)).isoformat()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    def describe(self) -> str:
+        parts = [{"active": "активные", "blocked": "заблокировавшие бота", "any": "все"}[self.status]]
+        if self.new_days is not None:
+            parts.append(f"пришли за {self.new_days} дн.")
+        if self.seen_days is not None:
+            parts.append(f"писали за {self.seen_days} дн.")
+        if self.lots and self.lots_days is not None:
+            parts.append(f"создавали лоты за {self.lots_days} дн.")
+        elif self.lots:
+            parts.append("создавали лоты")
+        elif self.lots is False:
+            parts.append("без лотов")
+        return ", ".join(parts)
+
+
+def _days(token: str, value: str) -> int:
+    try:
+        days = int(value)
+    except ValueError:
+        raise ValueError(f"{token}: нужно число дней")
+    if days <= 0:
+        raise ValueError(f"{token}: число дней должно быть больше нуля")
+    return days
+
+
+def parse_audience(args: str) -> Audience:
+    """Разбирает фильтры команды /all, например «seen=30 nolots». Ошибки — ValueError."""
+    audience = Audience()
+    for token in args.split():
+        name, _, value = token.lower().partition("=")
+        if name == "new" and value:
+            audience.new_days = _days(name, value)
+        elif name == "seen" and value:
+            audience.seen_days = _days(name, value)
+        elif name == "sellers":
+            audience.lots = True
+            audience.lots_days = _days(name, value) if value else None
+        elif name == "nolots" and not value:
+            audience.lots = False
+            audience.lots_days = None
+        elif name in ("blocked", "any") and not value:
+            audience.status = name
+        else:
+            raise ValueError(f"Неизвестный фильтр: {token}")
+    return audience
+
+
+class AudienceIndex:
+    """Индексы JSON-бэкенда для выборки аудиторий без полного перебора.
+
+    По каждому полю-дате (first_seen, last_seen, last_lot) пользователи
+    разложены по корзинам-дням. Выборка «не раньше cutoff» объединяет корзины
+    целиком и проверяет точное время только в граничном дне. Для аудиторий
+    без фильтров по датам размер считается по счётчикам, без построения множеств.
+    """
+
+    FIELDS = ("first_seen", "last_seen", "last_lot")
+
+    def __init__(self):
+        self._days: Dict[str, Dict[str, set[int]]] = {field: {} for field in self.FIELDS}
+        self._values: Dict[str, Dict[int, str]] = {field: {} for field in self.FIELDS}
+        self.blocked: set[int] = set()
+        # Сколько заблокировавших бота среди тех, у кого есть лоты
+        self._blocked_sellers = 0
+
+    def update(self, field: str, user_id: int, value: Optional[str]):
+        """Переносит пользователя в корзину нового значения поля (None — убрать)."""
+        values, days = self._values[field], self._days[field]
+        old = values.get(user_id)
+        if old == value:
+            return
+        if field == "last_lot" and user_id in self.blocked and (old is None) != (not value):
+            self._blocked_sellers += 1 if value else -1
+        if old is not None:
+            bucket = days[old[:10]]
+            bucket.discard(user_id)
+            if not bucket:
+                del days[old[:10]]
+        if value:
+            values[user_id] = value
+            days.setdefault(value[:10], set()).add(user_id)
+        else:
+            values.pop(user_id, None)
+
+    def set_active(self, user_id: int, active: bool):
+        if active == (user_id not in self.blocked):
+            return
+        if active:
+            self.blocked.discard(user_id)
+        else:
+            self.blocked.add(user_id)
+        if user_id in self._values["last_lot"]:
+            self._blocked_sellers += -1 if active else 1
+
+    def since(self, field: str, cutoff: str) -> set[int]:
+        """Пользователи, у которых поле не раньше cutoff."""
+        day, values = cutoff[:10], self._values[field]
+        result: set[int] = set()
+        for bucket_day, ids in self._days[field].items():
+            if bucket_day > day:
+                result |= ids
+            elif bucket_day == day:
+                result.update(uid for uid in ids if values[uid] >= cutoff)
+        return result
+
+    def select(self, audience: Audience, universe: Collection[int]) -> set[int]:
+        """Пользователи из universe (все ID хранилища), подходящие под аудиторию."""
+        selected: Optional[set[int]] = None
+        filters = []
+        if audience.new_days is not None:
+            filters.append(("first_seen", audience.new_days))
+        if audience.seen_days is not None:
+            filters.append(("last_seen", audience.seen_days))
+        if audience.lots and audience.lots_days is not None:
+            filters.append(("last_lot", audience.lots_days))
+        for field, days in filters:
+            ids = self.since(field, Audience.cutoff(days))
+            selected = ids if selected is None else selected & ids
+
+        if audience.lots and selected is None:
+            selected = set(self._values["last_lot"])
+        if selected is None:
+            selected = set(universe)
+        if audience.lots is False:
+            selected -= self._values["last_lot"].keys()
+
+        if audience.status == "active":
+            selected -= self.blocked
+        elif audience.status == "blocked":
+            selected &= self.blocked
+        return selected
+
+    def count(self, audience: Audience, universe: Collection[int]) -> int:
+        """Размер аудитории; universe — все ID хранилища."""
+        if audience.new_days is not None or audience.seen_days is not None or audience.lots_days is not None:
+            # Выборка по датам и так строится из корзин, а не из всей базы
+            return len(self.select(audience, universe))
+        if audience.lots:
+            total, blocked = len(self._values["last_lot"]), self._blocked_sellers
+        elif audience.lots is False:
+            total = len(universe) - len(self._values["last_lot"])
+            blocked = len(self.blocked) - self._blocked_sellers
+        else:
+            total, blocked = len(universe), len(self.blocked)
+        return {"active": total - blocked, "blocked": blocked, "any": total}[audience.status]
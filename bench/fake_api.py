@@ -0,0 +1,152 @@
+import json
+import time
+import random
+import asyncio
+import itertools
+from collections import Counter
+from typing import Optional, Dict, Any
+
+from aiohttp import web
+
+# ========== Поддельный сервер Bot API ==========
+# Отвечает на вызовы Bot API так, как это делает api.telegram.org, но локально:
+# getUpdates отдаёт обновления, поставленные через push_update(), отправка
+# сообщений только считается. Можно внедрять ошибки: 403 для «заблокировавших»
+# бота пользователей и 429 (retry_after) с заданной вероятностью.
+
+BOT_INFO = {"id": 42, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+# Методы, которые «отправляют» что-то в чат и подвержены внедрённым ошибкам
+SEND_METHODS = {"sendmessage", "copymessage", "copymessages", "forwardmessage", "sendphoto", "sendmediagroup"}
+
+
+class FakeBotAPI:
+    def __init__(
+        self,
+        blocked: Optional[set[int]] = None,
+        flood_rate: float = 0.0,
+        retry_after: int = 1,
+        latency: float = 0.0,
+        seed: int = 0,
+    ):
+        self.blocked = blocked or set()
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.latency = latency
+        self._random = random.Random(seed)
+        self._updates: list[Dict[str, Any]] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1_000_000)
+        self._new_updates = asyncio.Event()
+        self.pushed_at: Dict[int, float] = {}
+        # Статистика вызовов
+        self.calls: Counter = Counter()
+        self.delivered: Counter = Counter()   # (метод, chat_id) -> число успешных отправок
+        self.errors: Counter = Counter()      # код ошибки -> число
+        self.app = web.Application()
+        self.app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        self._runner: Optional[web.AppRunner] = None
+        self.port = 0
+
+    # ----- Управление -----
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{self.port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def push_update(self, update: Dict[str, Any]) -> int:
+        update_id = next(self._update_ids)
+        update["update_id"] = update_id
+        self._updates.append(update)
+        self.pushed_at[update_id] = time.perf_counter()
+        self._new_updates.set()
+        return update_id
+
+    def sent_to(self, chat_id: int, method: str = "copymessage") -> int:
+        return self.delivered[(method, chat_id)]
+
+    # ----- Обработка запросов -----
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        params = dict(await request.post())
+        self.calls[method] += 1
+        handler = getattr(self, f"_m_{method}", None)
+        if handler is None:
+            return self._ok(True)
+
+        if method in SEND_METHODS:
+            chat_id = int(params.get("chat_id", 0))
+            if chat_id in self.blocked:
+                return self._error(403, "Forbidden: bot was blocked by the user")
+            if self.flood_rate and self._random.random() < self.flood_rate:
+                return self._error(
+                    429, f"Too Many Requests: retry after {self.retry_after}",
+                    {"retry_after": self.retry_after},
+                )
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            self.delivered[(method, chat_id)] += 1
+
+        return self._ok(await handler(params))
+
+    def _ok(self, result: Any) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    def _error(self, code: int, description: str, parameters: Optional[Dict] = None) -> web.Response:
+        self.errors[code] += 1
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+    def _message(self, chat_id: Any, text: Optional[str] = None) -> Dict[str, Any]:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_INFO,
+        }
+        if text is not None:
+            message["text"] = text
+        return message
+
+    # ----- Методы Bot API -----
+    async def _m_getme(self, params):
+        return BOT_INFO
+
+    async def _m_getupdates(self, params):
+        offset = int(params.get("offset", 0))
+        timeout = float(params.get("timeout", 0))
+        limit = int(params.get("limit", 100))
+        # Подтверждённые (offset) обновления больше не отдаём
+        if offset:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    async def _m_sendmessage(self, params):
+        return self._message(params["chat_id"], params.get("text"))
+
+    async def _m_copymessage(self, params):
+        return {"message_id": next(self._message_ids)}
+
+    async def _m_copymessages(self, params):
+        return [{"message_id": next(self._message_ids)} for _ in json.loads(params["message_ids"])]
+
+    async def _m_editmessagetext(self, params):
+        return self._message(params["chat_id"], params.get("text"))
+
+    async def _m_deletewebhook(self, params):
+        return True
@@ -0,0 +1,289 @@
+"""Нагрузочный прогон бота без сети.
+
+Поднимает поддельный сервер Bot API (bench/fake_api.py) на localhost, запускает
+обычный Dispatcher бота в режиме поллинга против него и проигрывает
+синтетические потоки обновлений:
+
+    start      — шторм /start от новых пользователей
+    sell       — параллельные заявки через SellRobux (кнопка + количество)
+    relay      — переписка админа с продавцами через /chat
+    broadcast  — рассылка /all по большой базе с внедрёнными 403 и 429
+
+По каждому сценарию выводятся обновлений в секунду, p50/p99 времени обработки,
+прирост RSS, а для рассылки — время до завершения. С --output результаты
+сохраняются в JSON, чтобы сравнивать прогоны между собой.
+
+    python bench/run_bench.py --users 2000 --broadcast-users 20000 --storage sqlite
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+from typing import Optional, Dict, Any
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fake_api import FakeBotAPI
+
+ADMIN_ID = 1
+TOKEN = "42:BENCH"
+# Пользователи синтетической нагрузки начинаются с этого id
+FIRST_USER_ID = 10_000
+
+
+# ========== Измерения ==========
+def rss_bytes() -> int:
+    """Текущий RSS процесса (Linux); на других системах — пиковый."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class UpdateTimer:
+    """Outer-middleware диспетчера: точное время обработки каждого обновления."""
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.done = 0
+        self._changed = asyncio.Event()
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+            self.done += 1
+            self._changed.set()
+
+    async def wait_for(self, count: int, timeout: float):
+        deadline = time.monotonic() + timeout
+        while self.done < count:
+            self._changed.clear()
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise TimeoutError(f"обработано {self.done} из {count} обновлений")
+            try:
+                await asyncio.wait_for(self._changed.wait(), left)
+            except asyncio.TimeoutError:
+                pass
+
+
+# ========== Синтетические обновления ==========
+class UpdateFactory:
+    def __init__(self):
+        self._message_id = 0
+
+    def message(self, user_id: int, text: str, reply_to: Optional[int] = None) -> Dict[str, Any]:
+        self._message_id += 1
+        user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text,
+        }
+        if reply_to is not None:
+            message["reply_to_message"] = {
+                "message_id": reply_to,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+            }
+        return {"message": message}
+
+
+# ========== Прогон ==========
+class Bench:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.updates = UpdateFactory()
+        self.timer = UpdateTimer()
+        self.results: Dict[str, Dict[str, Any]] = {}
+        # «Заблокировавшие» бота — только среди получателей рассылки, не участвующих в диалогах
+        blocked = set()
+        if args.blocked_every:
+            blocked = set(range(FIRST_USER_ID + args.users, FIRST_USER_ID + args.broadcast_users, args.blocked_every))
+        self.api = FakeBotAPI(
+            blocked=blocked,
+            flood_rate=args.flood_rate,
+            retry_after=args.retry_after,
+            latency=args.api_latency,
+        )
+
+    async def feed(self, name: str, updates: list[Dict[str, Any]], timeout: float = 600.0) -> Dict[str, Any]:
+        """Отдаёт пачку обновлений через getUpdates и ждёт, пока все будут обработаны."""
+        first = len(self.timer.latencies)
+        target = self.timer.done + len(updates)
+        rss_before = rss_bytes()
+        started = time.perf_counter()
+        for update in updates:
+            self.api.push_update(update)
+        await self.timer.wait_for(target, timeout)
+        elapsed = time.perf_counter() - started
+        return self._record(name, elapsed, self.timer.latencies[first:], rss_before)
+
+    def _record(self, name: str, elapsed: float, latencies: list[float], rss_before: int, **extra) -> Dict[str, Any]:
+        result = {
+            "updates": len(latencies),
+            "seconds": round(elapsed, 3),
+            "updates_per_second": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "rss_growth_kb": (rss_bytes() - rss_before) // 1024,
+            **extra,
+        }
+        self.results[name] = result
+        return result
+
+    # ----- Сценарии -----
+    async def scenario_start(self):
+        users = range(FIRST_USER_ID, FIRST_USER_ID + self.args.users)
+        await self.feed("start", [self.updates.message(u, "/start") for u in users])
+
+    async def scenario_sell(self):
+        users = range(FIRST_USER_ID, FIRST_USER_ID + self.args.users)
+        # Шаги одного пользователя последовательны, разные пользователи — параллельны
+        await self.feed("sell_button", [self.updates.message(u, "📢 ПРОДАТЬ РОБУКСЫ") for u in users])
+        result = await self.feed("sell_amount", [self.updates.message(u, str(100 + u % 900)) for u in users])
+        result["admin_notifications"] = self.api.sent_to(ADMIN_ID, "sendmessage")
+
+    async def scenario_relay(self):
+        sellers = list(range(FIRST_USER_ID, FIRST_USER_ID + min(self.args.relay_sessions, self.args.users)))
+        await self.feed("relay_open", [self.updates.message(ADMIN_ID, f"/chat {u}") for u in sellers])
+        chatter = []
+        for round_no in range(self.args.relay_rounds):
+            for u in sellers:
+                chatter.append(self.updates.message(u, f"Сообщение {round_no} от {u}"))
+            # Ответы админа уходят в текущий диалог
+            chatter.append(self.updates.message(ADMIN_ID, f"Ответ {round_no}"))
+        await self.feed("relay_chatter", chatter)
+
+    async def scenario_broadcast(self):
+        import Rubaxskupkabot as bot_module
+
+        # База для рассылки заполняется напрямую, минуя /start
+        first_extra = FIRST_USER_ID + self.args.users
+        for user_id in range(first_extra, FIRST_USER_ID + self.args.broadcast_users):
+            await bot_module.storage.add_user(user_id, f"user{user_id}", f"User{user_id}")
+        recipients = len(await bot_module.get_all_users())
+
+        rss_before = rss_bytes()
+        copies_before = self.api.calls["copymessage"] + self.api.calls["copymessages"]
+        errors_before = dict(self.api.errors)
+        started = time.perf_counter()
+        await self.feed("broadcast_command", [self.updates.message(ADMIN_ID, "/all")])
+        await self.feed("broadcast_payload", [
+            self.updates.message(ADMIN_ID, f"📣 Тестовая рассылка, часть {i + 1}")
+            for i in range(self.args.payload_size)
+        ])
+        # Рассылка стартует после паузы сбора сообщений и идёт в фоне — ждём завершения
+        await bot_module.broadcast_payloads.join()
+        await bot_module.broadcasts.join()
+        elapsed = time.perf_counter() - started
+        self.results["broadcast"] = {
+            "recipients": recipients,
+            "seconds": round(elapsed, 3),
+            "messages_per_second": round(recipients / elapsed, 1) if elapsed else 0.0,
+            "payload_messages": self.args.payload_size,
+            "copy_calls": self.api.calls["copymessage"] + self.api.calls["copymessages"] - copies_before,
+            "forbidden_403": self.api.errors[403] - errors_before.get(403, 0),
+            "retry_after_429": self.api.errors[429] - errors_before.get(429, 0),
+            "rss_growth_kb": (rss_bytes() - rss_before) // 1024,
+        }
+
+    # ----- Запуск -----
+    async def run(self) -> Dict[str, Dict[str, Any]]:
+        base_url = await self.api.start()
+        os.environ.update({
+            "BOT_TOKEN": TOKEN,
+            "ADMIN_ID": str(ADMIN_ID),
+            "BOT_API_SERVER": base_url,
+            "STORAGE_BACKEND": self.args.storage,
+            "OUTBOUND_RATE": str(self.args.rate),
+            "OUTBOUND_PER_CHAT_RATE": str(self.args.rate),
+            "OUTBOUND_PER_CHAT_BURST": str(self.args.rate),
+            "THROTTLE_LIMIT": "1000000",
+            "BROADCAST_COLLECT_DELAY": "0.2",
+        })
+        # Бот пишет users.json, bot.db, fsm.db и журналы рассылок в текущий каталог
+        import Rubaxskupkabot as bot_module
+
+        bot = bot_module.create_bot()
+        dp = bot_module.create_dispatcher()
+        dp.update.outer_middleware(self.timer)
+        await bot_module.start_services(bot)
+        polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=1))
+        try:
+            for name in self.args.scenarios:
+                await getattr(self, f"scenario_{name}")()
+        finally:
+            await dp.stop_polling()
+            await polling
+            await bot_module.stop_services()
+            await bot.session.close()
+            await self.api.stop()
+        return self.results
+
+
+def report(results: Dict[str, Dict[str, Any]]):
+    for name, result in results.items():
+        fields = ", ".join(f"{key}={value}" for key, value in result.items())
+        print(f"{name:18} {fields}")
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота против поддельного Bot API")
+    parser.add_argument("--users", type=int, default=1000, help="пользователей в сценариях start/sell")
+    parser.add_argument("--broadcast-users", type=int, default=10000, help="размер базы для рассылки")
+    parser.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--scenarios", nargs="+", default=["start", "sell", "relay", "broadcast"],
+                        choices=["start", "sell", "relay", "broadcast"])
+    parser.add_argument("--relay-sessions", type=int, default=20, help="открытых диалогов админа")
+    parser.add_argument("--relay-rounds", type=int, default=20, help="сообщений от каждого собеседника")
+    parser.add_argument("--payload-size", type=int, default=1,
+                        help="сколько сообщений подряд отправляет админ для рассылки")
+    parser.add_argument("--rate", type=float, default=1000.0,
+                        help="бюджет исходящих запросов в секунду (у Telegram — около 30)")
+    parser.add_argument("--blocked-every", type=int, default=50, help="каждый N-й получатель отвечает 403 (0 — никто)")
+    parser.add_argument("--flood-rate", type=float, default=0.001, help="доля отправок, получающих 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, сек.")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа на отправку, сек.")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list[str]] = None):
+    args = parse_args(argv)
+    args.broadcast_users = max(args.broadcast_users, args.users)
+    logging.basicConfig(level=logging.WARNING)
+    output = os.path.abspath(args.output) if args.output else None
+
+    with tempfile.TemporaryDirectory(prefix="bot-bench-") as workdir:
+        os.chdir(workdir)
+        results = asyncio.run(Bench(args).run())
+
+    report(results)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
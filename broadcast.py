@@ -0,0 +1,498 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, Callable, Awaitable
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+from outbound import Priority, current_priority, slot_granted
+from storage import write_json_atomic
+
+# ========== Рассылка ==========
+# Рассылка идёт фоновой задачей: несколько воркеров берут получателей из очереди.
+# Запросы рассылки идут с низшим приоритетом через общий планировщик (outbound.py),
+# который держит суммарную скорость под лимитом Telegram (~30 сообщений/с) и
+# отдаёт рассылке только ёмкость, оставшуюся после диалогов и уведомлений.
+# При retry_after откладывается только этот получатель (планировщик блокирует
+# его чат), а воркер берёт следующего. Сетевые сбои и 5xx повторяет
+# HTTP-сессия (session.py); то, что не удалось и там, считается ошибкой.
+# Каждая рассылка ведёт журнал на диске, поэтому после перезапуска она продолжается
+# с того места, где остановилась.
+# Содержимое рассылки — одно или несколько сообщений админа (альбом или серия,
+# собранная PayloadCollector). Несколько сообщений уходят получателю одним
+# вызовом copyMessages: N сообщений стоят один запрос, альбом остаётся альбомом.
+# Медиа при копировании не загружаются заново — Telegram ссылается на уже
+# загруженные файлы, поэтому каждое вложение передаётся на сервер один раз.
+
+# Сколько сообщений принимает один вызов copyMessages
+COPY_MESSAGES_LIMIT = 100
+
+
+@dataclass
+class BroadcastStats:
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    retried: int = 0
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+
+# Коды записей в журнале рассылки
+SENDING = "p"   # отправка начата (результат неизвестен)
+RETRY = "r"     # отправка отложена (retry_after, остановка)
+SENT = "s"
+FAILED = "f"
+BLOCKED = "b"
+
+
+class BroadcastJournal:
+    """Журнал рассылки: <id>.json с параметрами задания и <id>.log с курсором по получателям.
+
+    В лог дописывается строка «<user_id> <код>» перед каждой отправкой и после неё.
+    При возобновлении получатель считается обработанным, если его последняя запись
+    не RETRY: так сообщение, отправка которого оборвалась на полпути, не уйдёт дважды.
+    """
+
+    def __init__(self, directory: str, job_id: str):
+        self.job_id = job_id
+        self.meta_path = os.path.join(directory, f"{job_id}.json")
+        self.log_path = os.path.join(directory, f"{job_id}.log")
+        self._log = None
+
+    @classmethod
+    def create(cls, directory: str, job_id: str, meta: Dict[str, Any]) -> "BroadcastJournal":
+        os.makedirs(directory, exist_ok=True)
+        journal = cls(directory, job_id)
+        write_json_atomic(journal.meta_path, meta)
+        return journal
+
+    @classmethod
+    def find(cls, directory: str) -> list["BroadcastJournal"]:
+        """Находит незавершённые рассылки в каталоге."""
+        if not os.path.isdir(directory):
+            return []
+        return [
+            cls(directory, name[:-len(".json")])
+            for name in sorted(os.listdir(directory))
+            if name.endswith(".json")
+        ]
+
+    def load_meta(self) -> Dict[str, Any]:
+        with open(self.meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def load_progress(self) -> Dict[int, str]:
+        """Возвращает последний код для каждого получателя из лога."""
+        progress: Dict[int, str] = {}
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.split()
+                    # Последняя строка могла оборваться при аварийной остановке
+                    if len(parts) == 2 and parts[0].lstrip('-').isdigit():
+                        progress[int(parts[0])] = parts[1]
+        return progress
+
+    def record(self, user_id: int, code: str):
+        if self._log is None:
+            self._log = open(self.log_path, "a", encoding="utf-8")
+        self._log.write(f"{user_id} {code}\n")
+        # Сбрасываем в ОС сразу: строка переживёт падение процесса
+        self._log.flush()
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def remove(self):
+        """Удаляет журнал завершённой рассылки."""
+        self.close()
+        for path in (self.meta_path, self.log_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class Broadcast:
+    """Одна рассылка: копирует сообщения from_chat_id/message_ids всем получателям."""
+
+    def __init__(
+        self,
+        bot: Bot,
+        from_chat_id: int,
+        message_ids: list[int],
+        recipients: list[int],
+        workers: int = 20,
+        max_retries: int = 3,
+        status_chat_id: Optional[int] = None,
+        status_message_id: Optional[int] = None,
+        progress_interval: float = 5.0,
+        journal: Optional[BroadcastJournal] = None,
+        on_blocked: Optional[Callable[[int], Awaitable[None]]] = None,
+        stats: Optional[BroadcastStats] = None,
+    ):
+        self.bot = bot
+        self.from_chat_id = from_chat_id
+        # copyMessages требует строго возрастающие ID
+        self.message_ids = sorted(set(message_ids))[:COPY_MESSAGES_LIMIT]
+        self.recipients = recipients
+        self.workers = max(1, min(workers, len(recipients)))
+        self.max_retries = max_retries
+        self.status_chat_id = status_chat_id
+        self.status_message_id = status_message_id
+        self.progress_interval = progress_interval
+        self.journal = journal
+        self.on_blocked = on_blocked
+        # При возобновлении статистика продолжается с сохранённых значений
+        self.stats = stats or BroadcastStats(total=len(recipients))
+        self._queue: asyncio.Queue[tuple[int, int]] = asyncio.Queue()
+        self._remaining = len(recipients)
+        self._finished = asyncio.Event()
+
+    def _record(self, user_id: int, code: str):
+        if self.journal is not None:
+            try:
+                self.journal.record(user_id, code)
+            except OSError as e:
+                logging.error(f"Рассылка: не удалось записать журнал: {e}")
+
+    def _complete(self, user_id: int, code: str):
+        self._record(user_id, code)
+        self._remaining -= 1
+        if self._remaining <= 0:
+            self._finished.set()
+
+    def _retry_later(self, user_id: int, attempt: int, delay: float):
+        """Возвращает получателя в очередь через delay секунд (воркер тем временем свободен)."""
+        self.stats.retried += 1
+        self._record(user_id, RETRY)
+        asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, (user_id, attempt + 1))
+
+    async def _mark_blocked(self, user_id: int):
+        if self.on_blocked is None:
+            return
+        try:
+            await self.on_blocked(user_id)
+        except Exception as e:
+            logging.error(f"Рассылка: не удалось пометить {user_id} неактивным: {e}")
+
+    async def _send(self, user_id: int, attempt: int):
+        self._record(user_id, SENDING)
+        slot_granted.set(False)
+        try:
+            if len(self.message_ids) == 1:
+                await self.bot.copy_message(user_id, self.from_chat_id, self.message_ids[0])
+            else:
+                await self.bot.copy_messages(user_id, self.from_chat_id, self.message_ids)
+        except asyncio.CancelledError:
+            # Остановка, пока запрос ждал очереди планировщика или паузы после 429:
+            # получатель вернётся в рассылку после перезапуска. Если слот уже выдан,
+            # запрос ушёл на сервер — остаётся SENDING, чтобы не отправить дважды
+            if not slot_granted.get():
+                self._record(user_id, RETRY)
+            raise
+        except TelegramRetryAfter as e:
+            if attempt < self.max_retries:
+                self._retry_later(user_id, attempt, e.retry_after)
+                return
+            self.stats.failed += 1
+            code = FAILED
+        except TelegramForbiddenError:
+            # Пользователь заблокировал бота — больше не будем ему писать
+            self.stats.blocked += 1
+            code = BLOCKED
+            await self._mark_blocked(user_id)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            logging.warning(f"Рассылка: не удалось отправить {user_id}: {e}")
+            self.stats.failed += 1
+            code = FAILED
+        except TelegramBadRequest:
+            # Чат не найден, пользователь удалён и т.п. — повтор не поможет
+            self.stats.failed += 1
+            code = FAILED
+        except Exception as e:
+            logging.error(f"Рассылка: ошибка при отправке {user_id}: {e}")
+            self.stats.failed += 1
+            code = FAILED
+        else:
+            self.stats.sent += 1
+            code = SENT
+        self._complete(user_id, code)
+
+    async def _worker(self):
+        # У задачи свой контекст: приоритет рассылки действует только на её запросы
+        current_priority.set(Priority.BROADCAST)
+        while True:
+            user_id, attempt = await self._queue.get()
+            await self._send(user_id, attempt)
+
+    def progress_text(self) -> str:
+        s = self.stats
+        return (
+            f"📤 Рассылка: {s.done}/{s.total}\n"
+            f"Успешно: {s.sent}\n"
+            f"Не удалось: {s.failed + s.blocked}"
+        )
+
+    def result_text(self) -> str:
+        s = self.stats
+        return f"✅ Рассылка завершена.\nУспешно: {s.sent}\nНе удалось: {s.failed + s.blocked}"
+
+    async def _edit_status(self, text: str):
+        if self.status_chat_id is None or self.status_message_id is None:
+            return
+        try:
+            await self.bot.edit_message_text(
+                text, chat_id=self.status_chat_id, message_id=self.status_message_id
+            )
+        except TelegramBadRequest:
+            pass  # «message is not modified» — прогресс не изменился
+        except Exception as e:
+            logging.warning(f"Рассылка: не удалось обновить статус: {e}")
+
+    async def _report_progress(self):
+        current_priority.set(Priority.BROADCAST)
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            await self._edit_status(self.progress_text())
+
+    async def run(self) -> BroadcastStats:
+        if not self.recipients:
+            await self._finish()
+            return self.stats
+        for user_id in self.recipients:
+            self._queue.put_nowait((user_id, 0))
+
+        tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        reporter = asyncio.create_task(self._report_progress())
+        started = time.monotonic()
+        try:
+            await self._finished.wait()
+        finally:
+            for task in tasks + [reporter]:
+                task.cancel()
+            await asyncio.gather(*tasks, reporter, return_exceptions=True)
+
+        logging.info(
+            f"Рассылка завершена за {time.monotonic() - started:.1f} с: "
+            f"успешно {self.stats.sent}, ошибок {self.stats.failed}, заблокировали {self.stats.blocked}"
+        )
+        await self._finish()
+        return self.stats
+
+    async def _finish(self):
+        if self.journal is not None:
+            self.journal.remove()
+        await self._edit_status(self.result_text())
+
+
+class BroadcastManager:
+    """Запускает рассылки в фоне и ведёт их журналы на диске."""
+
+    def __init__(
+        self,
+        workers: int = 20,
+        journal_dir: Optional[str] = None,
+        on_blocked: Optional[Callable[[int], Awaitable[None]]] = None,
+    ):
+        self.workers = workers
+        self.journal_dir = journal_dir
+        self.on_blocked = on_blocked
+        self.running: Dict[str, asyncio.Task] = {}
+
+    def _launch(self, job_id: str, job: Broadcast):
+        task = asyncio.create_task(job.run())
+        self.running[job_id] = task
+        task.add_done_callback(lambda t: self._on_done(job_id, job, t))
+
+    async def start(
+        self,
+        bot: Bot,
+        from_chat_id: int,
+        message_ids: list[int],
+        recipients: list[int],
+        status_chat_id: Optional[int] = None,
+        status_message_id: Optional[int] = None,
+    ) -> Broadcast:
+        job_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{min(message_ids)}"
+        journal = None
+        if self.journal_dir is not None:
+            # Список получателей большой базы пишется с fsync — не в цикле событий
+            journal = await asyncio.to_thread(BroadcastJournal.create, self.journal_dir, job_id, {
+                "from_chat_id": from_chat_id,
+                "message_ids": message_ids,
+                "status_chat_id": status_chat_id,
+                "status_message_id": status_message_id,
+                "recipients": recipients,
+            })
+        job = Broadcast(
+            bot,
+            from_chat_id,
+            message_ids,
+            recipients,
+            workers=self.workers,
+            status_chat_id=status_chat_id,
+            status_message_id=status_message_id,
+            journal=journal,
+            on_blocked=self.on_blocked,
+        )
+        self._launch(job_id, job)
+        return job
+
+    def resume(self, bot: Bot) -> list[Broadcast]:
+        """Продолжает рассылки, прерванные перезапуском, с сохранённого курсора."""
+        if self.journal_dir is None:
+            return []
+        jobs = []
+        for journal in BroadcastJournal.find(self.journal_dir):
+            if journal.job_id in self.running:
+                continue
+            try:
+                meta = journal.load_meta()
+                progress = journal.load_progress()
+            except (OSError, ValueError) as e:
+                logging.error(f"Рассылка {journal.job_id}: повреждённый журнал, пропускаю: {e}")
+                continue
+            recipients = meta["recipients"]
+            codes = list(progress.values())
+            stats = BroadcastStats(
+                total=len(recipients),
+                # Оборванная на полпути отправка, скорее всего, дошла — повторно не шлём
+                sent=codes.count(SENT) + codes.count(SENDING),
+                failed=codes.count(FAILED),
+                blocked=codes.count(BLOCKED),
+            )
+            remaining = [uid for uid in recipients if progress.get(uid, RETRY) == RETRY]
+            job = Broadcast(
+                bot,
+                meta["from_chat_id"],
+                # Журналы прежнего формата хранили одно сообщение
+                meta.get("message_ids") or [meta["message_id"]],
+                remaining,
+                workers=self.workers,
+                status_chat_id=meta.get("status_chat_id"),
+                status_message_id=meta.get("status_message_id"),
+                journal=journal,
+                on_blocked=self.on_blocked,
+                stats=stats,
+            )
+            logging.info(
+                f"Рассылка {journal.job_id}: продолжаю, осталось {len(remaining)} из {len(recipients)}"
+            )
+            self._launch(journal.job_id, job)
+            jobs.append(job)
+        return jobs
+
+    async def stop(self, timeout: float):
+        """Даёт рассылкам timeout секунд на завершение. Незавершённые останавливаются
+        и продолжатся после перезапуска по журналу."""
+        tasks = list(self.running.values())
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            logging.info(f"Остановлено рассылок: {len(pending)}, продолжатся после перезапуска")
+
+    async def join(self):
+        """Ждёт завершения всех запущенных рассылок."""
+        while self.running:
+            await asyncio.gather(*self.running.values(), return_exceptions=True)
+
+    def _on_done(self, job_id: str, job: Broadcast, task: asyncio.Task):
+        self.running.pop(job_id, None)
+        if job.journal is not None:
+            # Журнал незавершённой рассылки остаётся на диске до следующего запуска
+            job.journal.close()
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Рассылка {job_id} упала: {task.exception()!r}")
+
+
+class PayloadCollector:
+    """Собирает альбом или серию сообщений админа в одно содержимое рассылки.
+
+    Сообщения одного чата копятся, пока между ними меньше delay секунд; после
+    паузы (или при наборе max_items) вызывается on_ready с их ID. Части альбома
+    приходят отдельными обновлениями почти одновременно, поэтому тоже попадают
+    в одну пачку.
+    """
+
+    def __init__(self, delay: float = 1.0, max_items: int = COPY_MESSAGES_LIMIT):
+        self.delay = delay
+        self.max_items = max_items
+        self._pending: Dict[int, list[int]] = {}
+        self._callbacks: Dict[int, Callable[[list[int]], Awaitable[None]]] = {}
+        self._timers: Dict[int, asyncio.TimerHandle] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def pending(self) -> int:
+        """Сколько чатов сейчас собирают рассылку."""
+        return len(self._pending)
+
+    def add(self, chat_id: int, message_id: int, on_ready: Callable[[list[int]], Awaitable[None]]) -> int:
+        """Добавляет сообщение в пачку чата. Возвращает размер пачки."""
+        self._idle.clear()
+        batch = self._pending.setdefault(chat_id, [])
+        batch.append(message_id)
+        self._callbacks[chat_id] = on_ready
+        timer = self._timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+        if len(batch) >= self.max_items:
+            self._flush(chat_id)
+        else:
+            self._timers[chat_id] = asyncio.get_running_loop().call_later(self.delay, self._flush, chat_id)
+        return len(batch)
+
+    def cancel(self, chat_id: int) -> bool:
+        """Отбрасывает несобранную пачку (например, по /cancel)."""
+        timer = self._timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+        self._callbacks.pop(chat_id, None)
+        cancelled = self._pending.pop(chat_id, None) is not None
+        self._check_idle()
+        return cancelled
+
+    async def join(self):
+        """Ждёт, пока все пачки будут собраны и их on_ready отработают."""
+        await self._idle.wait()
+
+    def _check_idle(self):
+        if not self._pending and not self._tasks:
+            self._idle.set()
+
+    def _flush(self, chat_id: int):
+        self._timers.pop(chat_id, None)
+        batch = self._pending.pop(chat_id, None)
+        on_ready = self._callbacks.pop(chat_id, None)
+        if batch and on_ready is not None:
+            task = asyncio.create_task(on_ready(sorted(batch)))
+            self._tasks.add(task)
+            task.add_done_callback(self._on_done)
+        self._check_idle()
+
+    def _on_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        self._check_idle()
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Не удалось запустить рассылку: {task.exception()!r}")
@@ -0,0 +1,149 @@
+import json
+import time
+import sqlite3
+import asyncio
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, Callable
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+# ========== Хранилище состояний FSM в SQLite ==========
+# Состояния и данные FSM переживают перезапуск бота: пользователь, начавший
+# продажу, и админ, готовящий рассылку, продолжают с того же шага.
+# Записи старше ttl считаются устаревшими и удаляются. Последние записи держатся
+# в небольшом LRU-кэше (включая «состояния нет»), поэтому проверка состояния
+# на каждом сообщении обычно не обращается к диску. Запись — сквозная (write-through).
+
+FSM_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm(updated);
+"""
+
+
+class _Record:
+    __slots__ = ("state", "data", "updated")
+
+    def __init__(self, state: Optional[str] = None, data: Optional[Dict[str, Any]] = None, updated: float = 0.0):
+        self.state = state
+        self.data = data if data is not None else {}
+        self.updated = updated
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+class SqliteFSMStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх SQLite (WAL) с TTL и кэшем последних записей."""
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = 86400.0,
+        cache_size: int = 1024,
+        purge_interval: float = 600.0,
+        key_builder: Optional[KeyBuilder] = None,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.purge_interval = purge_interval
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+        self._cache: OrderedDict[str, _Record] = OrderedDict()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm-sqlite")
+        self._last_purge = time.time()
+
+    async def _run(self, fn: Callable, *args) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args))
+
+    def _connection(self) -> sqlite3.Connection:
+        # Подключение создаётся лениво, в потоке хранилища
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(FSM_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _expired(self, record: _Record) -> bool:
+        return record.updated < time.time() - self.ttl
+
+    def _remember(self, key: str, record: _Record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _select(self, key: str) -> _Record:
+        row = self._connection().execute(
+            "SELECT state, data, updated FROM fsm WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return _Record()
+        return _Record(row[0], json.loads(row[1]), row[2])
+
+    def _store(self, key: str, record: _Record):
+        conn = self._connection()
+        if record.empty:
+            conn.execute("DELETE FROM fsm WHERE key = ?", (key,))
+        else:
+            conn.execute(
+                "INSERT OR REPLACE INTO fsm (key, state, data, updated) VALUES (?, ?, ?, ?)",
+                (key, record.state, json.dumps(record.data, ensure_ascii=False), record.updated),
+            )
+        if record.updated - self._last_purge >= self.purge_interval:
+            self._last_purge = record.updated
+            conn.execute("DELETE FROM fsm WHERE updated < ?", (record.updated - self.ttl,))
+
+    async def _get(self, key: StorageKey) -> tuple[str, _Record]:
+        db_key = self.key_builder.build(key)
+        record = self._cache.get(db_key)
+        if record is None:
+            record = await self._run(self._select, db_key)
+            self._remember(db_key, record)
+        else:
+            self._cache.move_to_end(db_key)
+        if not record.empty and self._expired(record):
+            # Устаревшее состояние: пользователь давно бросил сценарий
+            record = _Record()
+            self._remember(db_key, record)
+            await self._run(self._store, db_key, _Record(updated=time.time()))
+        return db_key, record
+
+    async def _put(self, db_key: str, state: Optional[str], data: Dict[str, Any]):
+        record = _Record(state, data, time.time())
+        await self._run(self._store, db_key, record)
+        self._remember(db_key, record)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        db_key, record = await self._get(key)
+        await self._put(db_key, state.state if isinstance(state, State) else state, record.data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, record = await self._get(key)
+        return record.state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        db_key, record = await self._get(key)
+        await self._put(db_key, record.state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, record = await self._get(key)
+        return record.data.copy()
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
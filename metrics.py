@@ -0,0 +1,252 @@
+import os
+import time
+import asyncio
+import logging
+import functools
+from bisect import bisect_left
+from typing import Optional, Dict, Any, Callable, Awaitable
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.types import Message
+
+# ========== Метрики ==========
+# Счётчики и гистограммы задержек в памяти процесса. Гистограмма — фиксированный
+# набор корзин, поэтому наблюдение не создаёт новых объектов: только инкремент
+# элемента списка. Данные доступны админу через /stats и, по желанию,
+# в текстовом формате Prometheus (файл METRICS_FILE или порт METRICS_PORT).
+
+# Границы корзин гистограмм задержек, в секундах
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # последняя корзина — +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по корзинам (верхняя граница корзины)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else float("inf")
+        return float("inf")
+
+
+class Metrics:
+    """Реестр метрик: счётчики, гистограммы и вычисляемые показатели (gauge)."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters: Dict[str, Dict[str, int]] = {}
+        self.histograms: Dict[str, Dict[str, Histogram]] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+
+    def inc(self, name: str, label: str = "", value: int = 1):
+        series = self.counters.get(name)
+        if series is None:
+            series = self.counters[name] = {}
+        series[label] = series.get(label, 0) + value
+
+    def observe(self, name: str, seconds: float, label: str = ""):
+        series = self.histograms.get(name)
+        if series is None:
+            series = self.histograms[name] = {}
+        histogram = series.get(label)
+        if histogram is None:
+            histogram = series[label] = Histogram()
+        histogram.observe(seconds)
+
+    def gauge(self, name: str, fn: Callable[[], float]):
+        """Регистрирует показатель, который вычисляется в момент чтения метрик."""
+        self.gauges[name] = fn
+
+    def timed(self, name: str, label: str = ""):
+        """Декоратор для корутин: замеряет время выполнения и считает ошибки."""
+        # Имена серий строятся один раз, а не на каждый вызов
+        seconds_name, errors_name = f"{name}_seconds", f"{name}_errors_total"
+
+        def decorator(fn: Callable[..., Awaitable[Any]]):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception:
+                    self.inc(errors_name, label)
+                    raise
+                finally:
+                    self.observe(seconds_name, time.perf_counter() - started, label)
+            return wrapper
+        return decorator
+
+    # ----- Представление -----
+    def render_text(self) -> str:
+        """Краткая сводка для команды /stats."""
+        uptime = int(time.time() - self.started)
+        lines = [f"📊 Аптайм: {uptime // 3600} ч. {uptime % 3600 // 60} мин."]
+        for name, fn in sorted(self.gauges.items()):
+            lines.append(f"{name}: {self._gauge_value(fn):g}")
+        for name, series in sorted(self.counters.items()):
+            for label, value in sorted(series.items()):
+                lines.append(f"{name}{f'[{label}]' if label else ''}: {value}")
+        for name, series in sorted(self.histograms.items()):
+            for label, h in sorted(series.items()):
+                avg = h.sum / h.count if h.count else 0.0
+                lines.append(
+                    f"{name}{f'[{label}]' if label else ''}: n={h.count} "
+                    f"avg={avg * 1000:.1f}мс p50≤{h.quantile(0.5) * 1000:g}мс p99≤{h.quantile(0.99) * 1000:g}мс"
+                )
+        return "\n".join(lines)
+
+    def render_prometheus(self, prefix: str = "bot_") -> str:
+        """Метрики в текстовом формате Prometheus."""
+        lines = []
+        for name, fn in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {prefix}{name} gauge")
+            lines.append(f"{prefix}{name} {self._gauge_value(fn):g}")
+        for name, series in sorted(self.counters.items()):
+            lines.append(f"# TYPE {prefix}{name} counter")
+            for label, value in sorted(series.items()):
+                lines.append(f"{prefix}{name}{_labels(label)} {value}")
+        for name, series in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {prefix}{name} histogram")
+            for label, h in sorted(series.items()):
+                cumulative = 0
+                for bound, c in zip(h.bounds + (float("inf"),), h.counts):
+                    cumulative += c
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f"{prefix}{name}_bucket{_labels(label, le=le)} {cumulative}")
+                lines.append(f"{prefix}{name}_sum{_labels(label)} {h.sum:.6f}")
+                lines.append(f"{prefix}{name}_count{_labels(label)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _gauge_value(fn: Callable[[], float]) -> float:
+        try:
+            return float(fn())
+        except Exception:
+            return float("nan")
+
+
+def _labels(label: str, le: Optional[str] = None) -> str:
+    parts = []
+    if label:
+        parts.append(f'name="{label}"')
+    if le is not None:
+        parts.append(f'le="{le}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+# Общий реестр процесса
+metrics = Metrics()
+
+
+# ========== Сбор метрик ==========
+class MetricsMiddleware(BaseMiddleware):
+    """Замеряет обработку сообщений.
+
+    Как outer-middleware считает все входящие сообщения (update_seconds),
+    как обычная middleware с per_handler=True — время каждого обработчика
+    (handler_seconds[имя]).
+    """
+
+    def __init__(self, per_handler: bool = False, registry: Metrics = metrics):
+        self.per_handler = per_handler
+        self.registry = registry
+        prefix = "handler" if per_handler else "update"
+        self._seconds_name, self._errors_name = f"{prefix}_seconds", f"{prefix}_errors_total"
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        label = data["handler"].callback.__name__ if self.per_handler else ""
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.registry.inc(self._errors_name, label)
+            raise
+        finally:
+            self.registry.observe(self._seconds_name, time.perf_counter() - started, label)
+
+
+class RequestMetricsMiddleware(BaseRequestMiddleware):
+    """Замеряет каждый вызов Bot API (send_message, copy_message, ...) и считает retry_after."""
+
+    def __init__(self, registry: Metrics = metrics):
+        self.registry = registry
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot, method: TelegramMethod):
+        label = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            self.registry.inc("api_retry_after_total", label)
+            raise
+        except Exception:
+            self.registry.inc("api_errors_total", label)
+            raise
+        finally:
+            self.registry.observe("api_seconds", time.perf_counter() - started, label)
+
+
+# ========== Экспорт в формате Prometheus ==========
+def _write_file(path: str, text: str):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+async def run_exporter(
+    registry: Metrics = metrics,
+    path: Optional[str] = None,
+    port: Optional[int] = None,
+    interval: float = 15.0,
+):
+    """Фоновая задача: пишет метрики в файл и/или отдаёт их по HTTP на /metrics."""
+    runner = None
+    if port:
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(text=registry.render_prometheus(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", port).start()
+        logging.info(f"Метрики Prometheus: http://0.0.0.0:{port}/metrics")
+
+    try:
+        while True:
+            if path:
+                try:
+                    await asyncio.to_thread(_write_file, path, registry.render_prometheus())
+                except OSError as e:
+                    logging.error(f"Не удалось записать метрики в {path}: {e}")
+            await asyncio.sleep(interval)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
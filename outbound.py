@@ -0,0 +1,250 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Optional, Dict, Iterator
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+from metrics import metrics
+
+# ========== Планировщик исходящих сообщений ==========
+# Все вызовы Bot API, адресованные чату (send_message, copy_message, edit_* ...),
+# проходят через одну очередь с приоритетами и общим бюджетом: не больше rate
+# запросов в секунду на бота и per_chat_rate на чат. Слот получает самый
+# приоритетный запрос, чей чат сейчас свободен: диалоги админа с продавцами,
+# затем уведомления о лотах, а рассылка забирает оставшуюся ёмкость.
+# retry_after не заставляет каждого ждать отдельно: чат блокируется до общего
+# срока. Запрос рассылки при retry_after не повторяется здесь — ошибка сразу уходит
+# рассылке, которая откладывает только этого получателя. Рассылка целиком
+# приостанавливается, лишь когда retry_after приходит по нескольким разным чатам
+# подряд: это уже лимит на весь бот, а не на один чат.
+
+
+class Priority(IntEnum):
+    RELAY = 0       # ответы пользователям и диалоги админа с продавцами
+    ADMIN = 1       # уведомления админу о новых лотах
+    BROADCAST = 2   # массовая рассылка
+
+
+# Метки приоритетов в метриках
+PRIORITY_LABELS = {priority: priority.name.lower() for priority in Priority}
+
+# Приоритет текущей задачи; по умолчанию запросы считаются интерактивными
+current_priority: ContextVar[Priority] = ContextVar("outbound_priority", default=Priority.RELAY)
+# Получил ли последний запрос текущей задачи слот (то есть ушёл на сервер);
+# рассылка по нему отличает отмену в очереди от отмены уже отправленного запроса
+slot_granted: ContextVar[bool] = ContextVar("outbound_slot_granted", default=False)
+
+
+@contextmanager
+def outbound_priority(priority: Priority) -> Iterator[None]:
+    """Задаёт приоритет запросов к Bot API внутри блока with."""
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class TokenBucket:
+    """Ограничитель скорости: не более rate операций в секунду, всплески до capacity."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступна очередная операция (0 — сейчас)."""
+        self._refill(now)
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self._tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self._tokens >= self.capacity
+
+
+class _Waiter:
+    __slots__ = ("chat_id", "future", "queued")
+
+    def __init__(self, chat_id: int, future: asyncio.Future, queued: float):
+        self.chat_id = chat_id
+        self.future = future
+        self.queued = queued
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Middleware сессии бота: выдаёт запросам слоты по приоритету в рамках общего бюджета."""
+
+    def __init__(
+        self,
+        rate: float = 28.0,
+        per_chat_rate: float = 1.0,
+        per_chat_burst: float = 3.0,
+        max_retries: int = 2,
+        bulk_flood_chats: int = 3,
+        bulk_flood_window: float = 5.0,
+    ):
+        self.rate = rate
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self.bulk_flood_chats = bulk_flood_chats
+        self.bulk_flood_window = bulk_flood_window
+        self._bucket = TokenBucket(rate)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._chat_blocked: Dict[int, float] = {}
+        self._queues: Dict[Priority, deque[_Waiter]] = {p: deque() for p in Priority}
+        self._bulk_paused_until = 0.0
+        # Недавние retry_after рассылки: chat_id -> время
+        self._bulk_floods: Dict[int, float] = {}
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._last_sweep = time.monotonic()
+        for priority in Priority:
+            metrics.gauge(f"outbound_queue_{PRIORITY_LABELS[priority]}", lambda p=priority: len(self._queues[p]))
+
+    def depth(self, priority: Priority) -> int:
+        return len(self._queues[priority])
+
+    # ----- Ожидание слота -----
+    async def _acquire(self, priority: Priority, chat_id: int):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        waiter = _Waiter(chat_id, asyncio.get_running_loop().create_future(), time.monotonic())
+        self._queues[priority].append(waiter)
+        self._wakeup.set()
+        await waiter.future
+        metrics.observe("outbound_wait_seconds", time.monotonic() - waiter.queued, PRIORITY_LABELS[priority])
+
+    def _chat_delay(self, chat_id: int, now: float) -> float:
+        delay = max(0.0, self._chat_blocked.get(chat_id, 0.0) - now)
+        bucket = self._chats.get(chat_id)
+        if bucket is not None:
+            delay = max(delay, bucket.delay(now))
+        return delay
+
+    def _pick(self, now: float) -> tuple[Optional[_Waiter], Optional[Priority], float]:
+        """Самый приоритетный запрос, которому можно отправляться сейчас.
+        Если таких нет — через сколько секунд появится ближайший."""
+        soonest = float("inf")
+        for priority, queue in self._queues.items():
+            if priority == Priority.BROADCAST and self._bulk_paused_until > now:
+                soonest = min(soonest, self._bulk_paused_until - now)
+                continue
+            for waiter in queue:
+                if waiter.future.done():
+                    continue  # вызывающий уже отменил ожидание
+                delay = self._chat_delay(waiter.chat_id, now)
+                if delay == 0:
+                    return waiter, priority, 0.0
+                soonest = min(soonest, delay)
+        return None, None, soonest
+
+    def _drop_cancelled(self):
+        for queue in self._queues.values():
+            while queue and queue[0].future.done():
+                queue.popleft()
+
+    async def _dispatch(self):
+        while True:
+            self._drop_cancelled()
+            now = time.monotonic()
+            waiter, priority, soonest = self._pick(now)
+            if waiter is None:
+                # Ждём нового запроса или освобождения ближайшего чата
+                self._wakeup.clear()
+                timeout = None if soonest == float("inf") else soonest
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            delay = self._bucket.delay(now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue  # за время ожидания мог прийти более приоритетный запрос
+
+            self._queues[priority].remove(waiter)
+            self._bucket.take(now)
+            chat = self._chats.get(waiter.chat_id)
+            if chat is None:
+                chat = self._chats[waiter.chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            chat.take(now)
+            waiter.future.set_result(None)
+            if now - self._last_sweep >= 60:
+                self._sweep(now)
+
+    def _sweep(self, now: float):
+        """Забывает чаты, по которым бюджет полностью восстановился."""
+        for chat_id in [c for c, bucket in self._chats.items() if bucket.full(now)]:
+            del self._chats[chat_id]
+        for chat_id in [c for c, until in self._chat_blocked.items() if until <= now]:
+            del self._chat_blocked[chat_id]
+        self._last_sweep = now
+
+    def _backoff(self, chat_id: int, priority: Priority, retry_after: float):
+        """Один общий срок на все запросы, упёршиеся в retry_after, вместо отдельных пауз."""
+        until = time.monotonic() + retry_after
+        self._chat_blocked[chat_id] = max(self._chat_blocked.get(chat_id, 0.0), until)
+        if priority == Priority.BROADCAST and self._bot_wide_flood(chat_id):
+            self._bulk_paused_until = max(self._bulk_paused_until, until)
+            logging.warning(f"retry_after по нескольким чатам: рассылка на паузе {retry_after} с")
+        metrics.inc("outbound_retry_after_total", PRIORITY_LABELS[priority])
+        self._wakeup.set()
+
+    def _bot_wide_flood(self, chat_id: int) -> bool:
+        """retry_after рассылки пришёл по bulk_flood_chats разным чатам за bulk_flood_window секунд."""
+        now = time.monotonic()
+        border = now - self.bulk_flood_window
+        self._bulk_floods = {c: at for c, at in self._bulk_floods.items() if at > border}
+        self._bulk_floods[chat_id] = now
+        return len(self._bulk_floods) >= self.bulk_flood_chats
+
+    # ----- Middleware -----
+    @staticmethod
+    def handles(method: TelegramMethod) -> bool:
+        """Идёт ли запрос через очередь (и её обработку retry_after)."""
+        return isinstance(getattr(method, "chat_id", None), int)
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot, method: TelegramMethod):
+        if not self.handles(method):
+            # getUpdates, getMe, запросы к каналам по @username и т.п. — без очереди
+            return await make_request(bot, method)
+
+        chat_id = method.chat_id
+        priority = current_priority.get()
+        attempt = 0
+        while True:
+            await self._acquire(priority, chat_id)
+            slot_granted.set(True)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self._backoff(chat_id, priority, e.retry_after)
+                # Рассылка сама отложит получателя, не занимая воркер ожиданием
+                if priority == Priority.BROADCAST or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                logging.info(f"retry_after {e.retry_after} с для чата {chat_id}, повтор {attempt}")
+
+    async def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
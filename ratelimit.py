@@ -0,0 +1,135 @@
+import time
+from array import array
+from typing import Optional, Dict, Any, Hashable, Callable, Awaitable, Iterable
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message
+
+# ========== Ограничение частоты ==========
+# SlidingWindowLimiter — скользящее окно «не более limit событий за window секунд».
+# На каждый ключ хранится массив array('d') из не более чем limit отметок
+# time.monotonic(), а ключи, по которым давно не было событий, периодически
+# вычищаются — память не растёт с числом когда-либо писавших пользователей.
+
+
+class SlidingWindowLimiter:
+    """Скользящее окно: не более limit событий за window секунд на каждый ключ."""
+
+    def __init__(self, limit: int, window: float, sweep_interval: float = 60.0):
+        self.limit = limit
+        self.window = window
+        self.sweep_interval = sweep_interval
+        self._hits: Dict[Hashable, array] = {}
+        self._last_sweep = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._hits)
+
+    def hit(self, key: Hashable) -> Optional[float]:
+        """Регистрирует событие. Возвращает None, если оно разрешено,
+        иначе — сколько секунд ждать до освобождения окна."""
+        now = time.monotonic()
+        if now - self._last_sweep >= self.sweep_interval:
+            self.sweep(now)
+
+        stamps = self._hits.get(key)
+        if stamps is None:
+            self._hits[key] = array('d', (now,))
+            return None
+
+        # Отбрасываем отметки, выпавшие из окна (они всегда в начале массива)
+        border = now - self.window
+        expired = 0
+        for stamp in stamps:
+            if stamp > border:
+                break
+            expired += 1
+        if expired:
+            del stamps[:expired]
+
+        if len(stamps) >= self.limit:
+            return stamps[0] + self.window - now
+        stamps.append(now)
+        return None
+
+    def snapshot(self) -> Dict[Hashable, list[float]]:
+        """Отметки в виде времени time.time(): monotonic не переживает перезапуск процесса."""
+        offset = time.time() - time.monotonic()
+        border = time.monotonic() - self.window
+        return {
+            key: [stamp + offset for stamp in stamps if stamp > border]
+            for key, stamps in self._hits.items()
+            if stamps and stamps[-1] > border
+        }
+
+    def restore(self, state: Dict[Hashable, list[float]]):
+        offset = time.time() - time.monotonic()
+        border = time.monotonic() - self.window
+        for key, stamps in state.items():
+            alive = [stamp - offset for stamp in stamps if stamp - offset > border]
+            if alive:
+                self._hits[key] = array('d', alive[-self.limit:])
+
+    def sweep(self, now: Optional[float] = None):
+        """Удаляет ключи, у которых все события вышли за пределы окна."""
+        now = time.monotonic() if now is None else now
+        border = now - self.window
+        stale = [key for key, stamps in self._hits.items() if not stamps or stamps[-1] <= border]
+        for key in stale:
+            del self._hits[key]
+        self._last_sweep = now
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Outer-middleware: отбрасывает сообщения пользователя, если он пишет слишком часто.
+
+    Срабатывает до фильтров и обработчиков, поэтому флуд не доходит ни до
+    хранилища, ни до ответов бота. О превышении пользователь узнаёт один раз
+    за серию. Альбом (сообщения с общим media_group_id) считается одним
+    сообщением: все его части пропускаются или отбрасываются вместе.
+    """
+
+    def __init__(self, limiter: SlidingWindowLimiter, exempt: Iterable[int] = ()):
+        self.limiter = limiter
+        self.exempt = set(exempt)
+        self._warned = SlidingWindowLimiter(limit=1, window=limiter.window, sweep_interval=limiter.sweep_interval)
+        # Решение по первой части альбома: (user_id, media_group_id) -> (время, пропущен ли)
+        self._albums: Dict[tuple[int, str], tuple[float, bool]] = {}
+        self._last_sweep = time.monotonic()
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = event.from_user
+        if user is None or user.id in self.exempt:
+            return await handler(event, data)
+
+        album = (user.id, event.media_group_id) if event.media_group_id else None
+        if album is not None and album in self._albums:
+            # Остальные части альбома разделяют судьбу первой
+            if self._albums[album][1]:
+                return await handler(event, data)
+            return None
+
+        wait = self.limiter.hit(user.id)
+        if album is not None:
+            self._remember_album(album, wait is None)
+        if wait is None:
+            return await handler(event, data)
+
+        # Предупреждаем не чаще раза в окно, остальное молча отбрасываем
+        if self._warned.hit(user.id) is None:
+            await event.answer(f"⏳ Слишком много сообщений. Подождите {max(1, round(wait))} сек.")
+        return None
+
+    def _remember_album(self, album: tuple[int, str], allowed: bool):
+        now = time.monotonic()
+        if now - self._last_sweep >= self.limiter.sweep_interval:
+            # Части альбома приходят почти одновременно — старые решения не нужны
+            border = now - self.limiter.window
+            self._albums = {key: value for key, value in self._albums.items() if value[0] > border}
+            self._last_sweep = now
+        self._albums[album] = (now, allowed)
@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Dict, Any
+
+# ========== Диалоги администратора с пользователями ==========
+# Админ может вести несколько диалогов одновременно. Сообщения пользователей
+# копируются админу, а ID копии запоминается: ответ (reply) админа на такое
+# сообщение уходит именно этому пользователю. Сообщения без reply уходят
+# в «текущий» диалог — последний открытый командой /chat.
+
+
+class LRUMap:
+    """Словарь ограниченного размера: при переполнении вытесняются самые старые ключи."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict[int, int] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def set(self, key: int, value: int):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key: int) -> Optional[int]:
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def items(self) -> list[tuple[int, int]]:
+        """Пары от самых старых к самым свежим."""
+        return list(self._data.items())
+
+
+class RelaySessions:
+    """Открытые диалоги админа и связь «сообщение у админа -> пользователь»."""
+
+    def __init__(self, max_links: int = 10000):
+        self.sessions: Dict[int, datetime] = {}   # user_id -> время открытия
+        self.current: Optional[int] = None        # диалог для сообщений без reply
+        self.last_sender: Optional[int] = None    # чьё сообщение админ видел последним
+        self._links = LRUMap(max_links)
+
+    def open(self, user_id: int):
+        self.sessions.setdefault(user_id, datetime.now())
+        self.current = user_id
+
+    def close(self, user_id: int):
+        self.sessions.pop(user_id, None)
+        if self.current == user_id:
+            # Текущим становится последний из оставшихся диалогов
+            self.current = next(reversed(self.sessions), None)
+        if self.last_sender == user_id:
+            self.last_sender = None
+
+    def is_open(self, user_id: int) -> bool:
+        return user_id in self.sessions
+
+    def link(self, admin_message_id: int, user_id: int):
+        """Запоминает, что сообщение admin_message_id в чате админа относится к user_id."""
+        self._links.set(admin_message_id, user_id)
+
+    def resolve(self, admin_message_id: int) -> Optional[int]:
+        """Возвращает пользователя, к которому относится сообщение в чате админа."""
+        return self._links.get(admin_message_id)
+
+    # ----- Снимок для перезапуска -----
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "sessions": dict(self.sessions),
+            "current": self.current,
+            "last_sender": self.last_sender,
+            "links": self._links.items(),
+        }
+
+    def restore(self, state: Dict[str, Any]):
+        self.sessions = dict(state["sessions"])
+        self.current = state["current"]
+        self.last_sender = state["last_sender"]
+        for admin_message_id, user_id in state["links"]:
+            self._links.set(admin_message_id, user_id)
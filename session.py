@@ -0,0 +1,142 @@
+import random
+import asyncio
+import logging
+from typing import Optional, Dict, Callable
+
+from aiohttp import ClientConnectorError
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import (
+    TelegramEntityTooLarge,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from metrics import metrics
+
+# ========== HTTP-сессия Bot API ==========
+# Сессия aiogram с настраиваемым пулом соединений и единой политикой повторов.
+# Пул держит keep-alive соединения к серверу Bot API, поэтому всплеск рассылки
+# не открывает TLS-соединение на каждый запрос; DNS кэшируется на dns_ttl.
+# Временные сбои (5xx, обрыв соединения, таймаут) и retry_after повторяются
+# с экспоненциальной задержкой и случайным разбросом, чтобы параллельные
+# запросы не возвращались к серверу одновременно. Отправка сообщений не
+# идемпотентна: после таймаута или обрыва сообщение могло уже дойти, поэтому
+# её повторяем только если соединение не удалось даже установить.
+
+# Таймауты по методам, в секундах; остальные — timeout сессии
+METHOD_TIMEOUTS: Dict[str, float] = {
+    "sendPhoto": 120,
+    "sendVideo": 180,
+    "sendDocument": 180,
+    "sendAudio": 120,
+    "sendVoice": 60,
+    "sendAnimation": 120,
+    "sendMediaGroup": 180,
+}
+
+# У поллинга своя пауза между ошибками — не повторяем его здесь
+NO_RETRY_METHODS = {"getUpdates"}
+# Методы, повтор которых после отправленного запроса может продублировать сообщение
+NON_IDEMPOTENT_PREFIXES = ("send", "copy", "forward")
+
+
+def _not_sent(error: TelegramNetworkError) -> bool:
+    """Сетевая ошибка возникла до отправки запроса (не удалось подключиться)."""
+    # aiogram поднимает TelegramNetworkError внутри except — исходная ошибка в __context__
+    return isinstance(error.__context__, ClientConnectorError)
+
+
+class TunedSession(AiohttpSession):
+    """AiohttpSession с настраиваемым пулом, таймаутами по методам и повторами.
+
+    defer_retry_after — методы, чей retry_after обрабатывает кто-то снаружи
+    (планировщик исходящих сообщений): для них ошибка пробрасывается сразу.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 0,
+        keepalive_timeout: float = 30.0,
+        dns_ttl: int = 300,
+        timeout: float = 20.0,
+        method_timeouts: Optional[Dict[str, float]] = None,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 10.0,
+        defer_retry_after: Optional[Callable[[TelegramMethod], bool]] = None,
+        **kwargs,
+    ):
+        super().__init__(limit=limit, timeout=timeout, **kwargs)
+        self._connector_init.update(
+            limit_per_host=limit_per_host,
+            keepalive_timeout=keepalive_timeout,
+            ttl_dns_cache=dns_ttl,
+        )
+        self.limit = limit
+        self.method_timeouts = METHOD_TIMEOUTS if method_timeouts is None else method_timeouts
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.defer_retry_after = defer_retry_after
+        metrics.gauge("http_pool_limit", lambda: self.limit)
+        metrics.gauge("http_pool_in_use", lambda: self.pool_stats()["in_use"])
+        metrics.gauge("http_pool_idle", lambda: self.pool_stats()["idle"])
+        metrics.gauge("http_pool_waiting", lambda: self.pool_stats()["waiting"])
+
+    # ----- Пул соединений -----
+    def pool_stats(self) -> Dict[str, int]:
+        """Занятые, свободные (keep-alive) соединения и запросы, ждущие соединения."""
+        connector = self._session.connector if self._session is not None and not self._session.closed else None
+        if connector is None:
+            return {"in_use": 0, "idle": 0, "waiting": 0}
+        # Внутренние поля TCPConnector: публичного API для этого у aiohttp нет
+        acquired = getattr(connector, "_acquired", ())
+        conns = getattr(connector, "_conns", {})
+        waiters = getattr(connector, "_waiters", {})
+        return {
+            "in_use": len(acquired),
+            "idle": sum(len(c) for c in conns.values()),
+            "waiting": sum(len(w) for w in waiters.values()),
+        }
+
+    # ----- Повторы -----
+    def backoff(self, attempt: int) -> float:
+        """Задержка перед повтором: экспонента с полным случайным разбросом."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def make_request(
+        self, bot: Bot, method: TelegramMethod[TelegramType], timeout: Optional[int] = None
+    ) -> TelegramType:
+        name = method.__api_method__
+        if timeout is None:
+            timeout = self.method_timeouts.get(name)
+        if name in NO_RETRY_METHODS:
+            return await super().make_request(bot, method, timeout)
+
+        attempt = 0
+        while True:
+            try:
+                return await super().make_request(bot, method, timeout)
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries or (self.defer_retry_after and self.defer_retry_after(method)):
+                    raise
+                reason, delay = "retry_after", e.retry_after + random.uniform(0, self.backoff_base)
+            except TelegramEntityTooLarge:
+                raise  # повтор не поможет
+            except TelegramServerError:
+                if attempt >= self.max_retries:
+                    raise
+                reason, delay = "server_error", self.backoff(attempt)
+            except TelegramNetworkError as e:
+                if attempt >= self.max_retries or (name.startswith(NON_IDEMPOTENT_PREFIXES) and not _not_sent(e)):
+                    raise
+                reason, delay = "network_error", self.backoff(attempt)
+            attempt += 1
+            metrics.inc("http_retries_total", reason)
+            logging.info(f"{name}: {reason}, повтор {attempt} через {delay:.1f} с")
+            await asyncio.sleep(delay)
@@ -0,0 +1,847 @@
+import os
+import sys
+import time
+import json
+import sqlite3
+import asyncio
+import logging
+import tempfile
+import functools
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, Iterable, Callable
+
+from audience import Audience, AudienceIndex
+from lifecycle import load_snapshot, save_snapshot
+from metrics import metrics
+
+# ========== Хранилища данных бота ==========
+# Бэкенды:
+#   JsonStorage   — users.json в памяти с отложенной записью (по умолчанию);
+#   SqliteStorage — SQLite в режиме WAL, запросы выполняются в отдельном потоке,
+#                   чтобы не блокировать цикл событий.
+
+# Время последней активности (last_seen) обновляется не чаще раза за этот интервал,
+# чтобы каждое сообщение пользователя не превращалось в запись на диск
+SEEN_RESOLUTION = timedelta(hours=1)
+
+
+def load_users_json(path: str) -> Dict[int, Dict[str, Any]]:
+    """Загружает список пользователей из JSON-файла."""
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+            # Преобразуем ключи в int
+            return {int(k): v for k, v in data.items()}
+    return {}
+
+
+def load_lots_jsonl(path: str) -> list[Dict[str, Any]]:
+    """Читает журнал лотов (JSON Lines), пропуская повреждённые и оборванные строки."""
+    lots = []
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    lots.append(json.loads(line))
+                except ValueError:
+                    logging.error(f"{path}: повреждённая запись, пропускаю")
+    return lots
+
+
+def file_stamp(path: str) -> Optional[tuple[int, int]]:
+    """Время изменения и размер файла — чтобы понять, не менялся ли он с момента снимка."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def username_key(username: str) -> str:
+    """Ключ индекса username: без @ и без учёта регистра."""
+    return username.lstrip('@').casefold()
+
+
+def username_owners(users: Iterable[tuple[int, Dict[str, Any]]]) -> Dict[int, str]:
+    """Владелец каждого username: пользователь, которого видели с ним последним.
+
+    Принимает пары (id, запись), возвращает id -> ключ username.
+    При равенстве побеждает запись, идущая позже.
+    """
+    owners: Dict[str, tuple[str, int]] = {}
+    for user_id, record in users:
+        if not record.get("username"):
+            continue
+        key = username_key(record["username"])
+        seen = record.get("username_seen") or record.get("first_seen") or ""
+        if key not in owners or seen >= owners[key][0]:
+            owners[key] = (seen, user_id)
+    return {user_id: key for key, (_, user_id) in owners.items()}
+
+
+def write_json_atomic(path: str, data: Any):
+    """Атомарно записывает JSON: сначала во временный файл, затем rename поверх старого."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}-", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class BotStorage(ABC):
+    """Общий интерфейс хранилища пользователей и времени последних заявок."""
+
+    async def open(self):
+        """Подготовка хранилища при старте бота."""
+
+    async def close(self):
+        """Сохранение данных и освобождение ресурсов при остановке."""
+
+    @abstractmethod
+    async def add_user(self, user_id: int, username: str = None, first_name: str = None):
+        """Добавляет пользователя или обновляет имя/юзернейм, если они изменились."""
+
+    @abstractmethod
+    async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Возвращает запись пользователя по ID (или None)."""
+
+    @abstractmethod
+    async def get_user_by_username(self, username: str) -> Optional[int]:
+        """Возвращает ID пользователя по username (без @)."""
+
+    @abstractmethod
+    async def get_all_users(self) -> list[int]:
+        """Возвращает список ID активных пользователей (не заблокировавших бота)."""
+
+    @abstractmethod
+    async def select_users(self, audience: Audience) -> list[int]:
+        """Возвращает ID пользователей, подходящих под фильтры рассылки."""
+
+    @abstractmethod
+    async def count_audience(self, audience: Audience) -> int:
+        """Возвращает число пользователей, подходящих под фильтры рассылки."""
+
+    @abstractmethod
+    async def set_user_active(self, user_id: int, active: bool):
+        """Помечает пользователя активным/неактивным (например, заблокировал бота)."""
+
+    @abstractmethod
+    async def count_users(self) -> int:
+        """Возвращает количество пользователей."""
+
+    @abstractmethod
+    async def get_last_request(self, user_id: int) -> Optional[datetime]:
+        """Возвращает время последней заявки пользователя (или None)."""
+
+    @abstractmethod
+    async def set_last_request(self, user_id: int, when: datetime):
+        """Запоминает время последней заявки пользователя."""
+
+    @abstractmethod
+    async def add_lot(self, lot: Dict[str, Any]) -> bool:
+        """Дописывает лот в журнал. Возвращает False, если такой номер уже занят."""
+
+    @abstractmethod
+    async def get_lot(self, number: str) -> Optional[Dict[str, Any]]:
+        """Возвращает лот по номеру (вида #ABC123) или None."""
+
+    @abstractmethod
+    async def get_user_lots(self, user_id: int, limit: int = 20) -> tuple[list[Dict[str, Any]], int]:
+        """Возвращает последние лоты пользователя (новые первыми) и их общее число."""
+
+
+# ========== Журнал лотов (JSON Lines) ==========
+class LotLedger:
+    """Журнал лотов только на дозапись: одна JSON-строка на лот.
+
+    В памяти держится не сами лоты, а индексы «номер -> смещение строки в файле»
+    и «пользователь -> смещения его лотов», поэтому поиск по номеру и по
+    пользователю не зависит от размера журнала, а память — десятки байт на лот.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._by_number: Dict[str, int] = {}
+        self._by_user: Dict[int, list[int]] = {}
+        # Время последнего лота каждого пользователя (для аудиторий рассылок)
+        self.last_created: Dict[int, str] = {}
+        self._file = None
+        self._size = 0
+        self._append_lock = asyncio.Lock()
+
+    def open(self):
+        self._by_number.clear()
+        self._by_user.clear()
+        self.last_created.clear()
+        if os.path.exists(self.path):
+            valid_size = 0
+            with open(self.path, "rb") as f:
+                offset = 0
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # оборванная при аварии последняя строка
+                    try:
+                        lot = json.loads(line)
+                    except ValueError:
+                        logging.error(f"{self.path}: повреждённая запись на смещении {offset}, пропускаю")
+                    else:
+                        self._index(lot, offset)
+                    offset += len(line)
+                valid_size = offset
+            if valid_size != os.path.getsize(self.path):
+                # Иначе следующая запись склеится с обрывком
+                os.truncate(self.path, valid_size)
+        self._file = open(self.path, "ab")
+        self._size = self._file.tell()
+        logging.info(f"Загружено лотов: {len(self._by_number)}")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _index(self, lot: Dict[str, Any], offset: int):
+        self._by_number[lot["lot"]] = offset
+        self._by_user.setdefault(lot["user_id"], []).append(offset)
+        self.last_created[lot["user_id"]] = lot["created"]
+
+    def _read_at(self, offset: int) -> Dict[str, Any]:
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def _append(self, line: bytes):
+        self._file.write(line)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    async def add(self, lot: Dict[str, Any]) -> bool:
+        line = json.dumps(lot, ensure_ascii=False).encode("utf-8") + b"\n"
+        # Записи идут строго по одной: так смещение каждой строки известно заранее
+        async with self._append_lock:
+            if lot["lot"] in self._by_number:
+                return False
+            await asyncio.to_thread(self._append, line)
+            self._index(lot, self._size)
+            self._size += len(line)
+        return True
+
+    async def get(self, number: str) -> Optional[Dict[str, Any]]:
+        offset = self._by_number.get(number)
+        if offset is None:
+            return None
+        return await asyncio.to_thread(self._read_at, offset)
+
+    async def get_by_user(self, user_id: int, limit: int) -> tuple[list[Dict[str, Any]], int]:
+        offsets = self._by_user.get(user_id, [])
+        recent = offsets[-limit:][::-1]
+        lots = await asyncio.to_thread(lambda: [self._read_at(o) for o in recent])
+        return lots, len(offsets)
+
+
+# ========== JSON-бэкенд ==========
+class JsonStorage(BotStorage):
+    """Реестр пользователей в памяти с отложенной (write-behind) записью в JSON-файл.
+
+    Файл читается один раз при старте, дальше все обращения идут к словарю в памяти.
+    Изменённые записи помечаются «грязными» и сбрасываются на диск пачкой
+    фоновой задачей и при остановке бота. Время последней заявки хранится
+    в записи пользователя (поле last_request), поэтому переживает перезапуск.
+
+    Поиск по username идёт через индекс username -> id, который обновляется
+    при смене юзернейма. Если один и тот же username встречается у нескольких
+    пользователей (юзернейм освободили и заняли снова), он принадлежит тому,
+    кого видели с ним последним (поле username_seen).
+
+    Пользователи, заблокировавшие бота, помечаются "active": false и не попадают
+    в get_all_users(), пока снова не напишут боту. Лоты хранятся в LotLedger.
+    Аудитории рассылок выбираются по AudienceIndex, который строится при
+    старте и обновляется вместе с записями.
+
+    При остановке реестр дополнительно сохраняется в бинарный снимок
+    (snapshot_path). Если users.json с тех пор не менялся, при старте читается
+    снимок, а не JSON — это заметно быстрее на большой базе.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        flush_interval: float = 5.0,
+        lots_path: str = "lots.jsonl",
+        snapshot_path: Optional[str] = None,
+    ):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.flush_interval = flush_interval
+        self.lots = LotLedger(lots_path)
+        self._users: Dict[int, Dict[str, Any]] = {}
+        self._dirty: set[int] = set()
+        self._by_username: Dict[str, int] = {}
+        self._audience = AudienceIndex()
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def _load(self) -> Dict[int, Dict[str, Any]]:
+        if self.snapshot_path is not None:
+            state = load_snapshot(self.snapshot_path)
+            stamp = file_stamp(self.path)
+            if state is not None and stamp is not None and state.get("source") == stamp:
+                logging.info(f"Пользователи загружены из снимка {self.snapshot_path}")
+                return state["users"]
+        return load_users_json(self.path)
+
+    def _save_snapshot(self):
+        save_snapshot(self.snapshot_path, {"source": file_stamp(self.path), "users": self._users})
+
+    async def open(self):
+        started = time.perf_counter()
+        self._users = self._load()
+        metrics.observe("json_load_seconds", time.perf_counter() - started)
+        self._dirty.clear()
+        self._build_username_index()
+        logging.info(f"Загружено пользователей: {len(self._users)}")
+        self.lots.open()
+        self._build_audience_index()
+        self._flush_task = asyncio.create_task(self._run_flusher())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        # Финальный сброс изменений при остановке
+        await self.flush()
+        self.lots.close()
+        if self.snapshot_path is not None and os.path.exists(self.path):
+            try:
+                await asyncio.to_thread(self._save_snapshot)
+            except Exception as e:
+                logging.error(f"Не удалось сохранить снимок {self.snapshot_path}: {e}")
+
+    def _build_username_index(self):
+        owners = username_owners(self._users.items())
+        self._by_username = {key: uid for uid, key in owners.items()}
+
+    def _build_audience_index(self):
+        self._audience = AudienceIndex()
+        for uid, record in self._users.items():
+            self._index_audience(uid, record)
+        for uid, created in self.lots.last_created.items():
+            self._audience.update("last_lot", uid, created)
+
+    def _index_audience(self, user_id: int, record: Dict[str, Any]):
+        self._audience.update("first_seen", user_id, record.get("first_seen"))
+        # До появления last_seen пользователя точно видели при первом визите
+        self._audience.update("last_seen", user_id, record.get("last_seen") or record.get("first_seen"))
+        self._audience.set_active(user_id, record.get("active", True))
+
+    def _index_username(self, user_id: int, old_username: Optional[str], new_username: str):
+        # Удаляем устаревший ключ, только если он всё ещё указывает на этого пользователя
+        if old_username:
+            old_key = username_key(old_username)
+            if self._by_username.get(old_key) == user_id:
+                del self._by_username[old_key]
+        self._by_username[username_key(new_username)] = user_id
+
+    def _update(self, user_id: int, changes: Dict[str, Any]):
+        # Запись заменяется целиком, а не мутируется: так снимок словаря
+        # можно безопасно сериализовать в отдельном потоке во время flush()
+        self._users[user_id] = {**self._users[user_id], **changes}
+        self._dirty.add(user_id)
+        self._index_audience(user_id, self._users[user_id])
+
+    async def add_user(self, user_id: int, username: str = None, first_name: str = None):
+        record = self._users.get(user_id)
+        now = datetime.now()
+        if record is None:
+            seen = now.isoformat()
+            self._users[user_id] = {
+                "id": user_id,
+                "username": username,
+                "first_name": first_name,
+                "first_seen": seen,
+                "last_seen": seen
+            }
+            if username:
+                self._users[user_id]["username_seen"] = seen
+                self._index_username(user_id, None, username)
+            self._dirty.add(user_id)
+            self._index_audience(user_id, self._users[user_id])
+            return
+
+        changes = {}
+        # Смена юзернейма или повторное появление юзернейма, который индекс
+        # отдал другому пользователю: пользователь снова становится его владельцем
+        if username and (
+            record.get("username") != username
+            or self._by_username.get(username_key(username)) != user_id
+        ):
+            changes["username"] = username
+            changes["username_seen"] = datetime.now().isoformat()
+            self._index_username(user_id, record.get("username"), username)
+        if first_name and record.get("first_name") != first_name:
+            changes["first_name"] = first_name
+        if not record.get("active", True):
+            # Пользователь снова пишет боту — значит, разблокировал его
+            changes["active"] = True
+        last_seen = record.get("last_seen")
+        if changes or not last_seen or datetime.fromisoformat(last_seen) <= now - SEEN_RESOLUTION:
+            changes["last_seen"] = now.isoformat()
+        if changes:
+            self._update(user_id, changes)
+
+    async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return self._users.get(user_id)
+
+    async def get_user_by_username(self, username: str) -> Optional[int]:
+        return self._by_username.get(username_key(username))
+
+    async def get_all_users(self) -> list[int]:
+        return [uid for uid, record in self._users.items() if record.get("active", True)]
+
+    async def select_users(self, audience: Audience) -> list[int]:
+        return list(self._audience.select(audience, self._users.keys()))
+
+    async def count_audience(self, audience: Audience) -> int:
+        return self._audience.count(audience, self._users.keys())
+
+    async def set_user_active(self, user_id: int, active: bool):
+        record = self._users.get(user_id)
+        if record is not None and record.get("active", True) != active:
+            self._update(user_id, {"active": active})
+
+    async def count_users(self) -> int:
+        return len(self._users)
+
+    async def get_last_request(self, user_id: int) -> Optional[datetime]:
+        record = self._users.get(user_id)
+        if record and record.get("last_request"):
+            return datetime.fromisoformat(record["last_request"])
+        return None
+
+    async def set_last_request(self, user_id: int, when: datetime):
+        if user_id not in self._users:
+            await self.add_user(user_id)
+        self._update(user_id, {"last_request": when.isoformat()})
+
+    async def add_lot(self, lot: Dict[str, Any]) -> bool:
+        if not await self.lots.add(lot):
+            return False
+        self._audience.update("last_lot", lot["user_id"], lot["created"])
+        return True
+
+    async def get_lot(self, number: str) -> Optional[Dict[str, Any]]:
+        return await self.lots.get(number)
+
+    async def get_user_lots(self, user_id: int, limit: int = 20) -> tuple[list[Dict[str, Any]], int]:
+        return await self.lots.get_by_user(user_id, limit)
+
+    async def flush(self):
+        """Сбрасывает накопленные изменения на диск одной атомарной записью."""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            batch = self._dirty
+            self._dirty = set()
+            snapshot = dict(self._users)
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(write_json_atomic, self.path, snapshot)
+            except Exception:
+                # Не потеряем изменения: вернём их в очередь на следующую попытку
+                self._dirty |= batch
+                raise
+            metrics.observe("json_save_seconds", time.perf_counter() - started)
+            metrics.inc("json_saved_records_total", value=len(batch))
+            logging.debug(f"Сохранено изменений пользователей: {len(batch)}")
+
+    async def _run_flusher(self):
+        """Фоновая задача: периодически сбрасывает изменения на диск."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Не удалось сохранить {self.path}: {e}")
+
+
+# ========== SQLite-бэкенд ==========
+# Миграция схемы v2: если один username оказался у нескольких записей, оставляем
+# его за самой свежей (импорт из users.json делит username по username_seen)
+SQLITE_DEDUPE_USERNAMES = """
+    UPDATE users SET username_key = NULL
+    WHERE username_key IS NOT NULL AND EXISTS (
+        SELECT 1 FROM users AS other
+        WHERE other.username_key = users.username_key
+          AND (other.first_seen > users.first_seen
+               OR (other.first_seen = users.first_seen AND other.id > users.id))
+    );
+"""
+
+# Миграции схемы: применяются по порядку, номер последней хранится в PRAGMA user_version
+SQLITE_MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        first_seen TEXT NOT NULL,
+        last_request REAL
+    );
+    CREATE INDEX IF NOT EXISTS idx_users_username ON users(username COLLATE NOCASE);
+    CREATE INDEX IF NOT EXISTS idx_users_last_request ON users(last_request);
+    """,
+    # Индекс username -> id: ключ без учёта регистра, у каждого ключа один владелец
+    """
+    ALTER TABLE users ADD COLUMN username_key TEXT;
+    UPDATE users SET username_key = lower(username) WHERE username IS NOT NULL;
+    """ + SQLITE_DEDUPE_USERNAMES + """
+    DROP INDEX IF EXISTS idx_users_username;
+    CREATE INDEX IF NOT EXISTS idx_users_username_key ON users(username_key);
+    """,
+    # Пользователи, заблокировавшие бота, исключаются из рассылок
+    """
+    ALTER TABLE users ADD COLUMN active INTEGER NOT NULL DEFAULT 1;
+    CREATE INDEX IF NOT EXISTS idx_users_active ON users(active);
+    """,
+    # Журнал лотов: только вставка, поиск по номеру и по пользователю через индексы
+    """
+    CREATE TABLE IF NOT EXISTS lots (
+        lot TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        username TEXT,
+        amount INTEGER NOT NULL,
+        after_commission INTEGER NOT NULL,
+        price_fp REAL NOT NULL,
+        price_direct REAL NOT NULL,
+        created TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_lots_user ON lots(user_id, created);
+    """,
+    # Аудитории рассылок: давность прихода, последней активности и последнего лота
+    """
+    ALTER TABLE users ADD COLUMN last_seen TEXT;
+    ALTER TABLE users ADD COLUMN last_lot TEXT;
+    UPDATE users SET last_seen = first_seen;
+    UPDATE users SET last_lot = (SELECT MAX(created) FROM lots WHERE lots.user_id = users.id);
+    CREATE INDEX IF NOT EXISTS idx_users_first_seen ON users(first_seen);
+    CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen);
+    CREATE INDEX IF NOT EXISTS idx_users_last_lot ON users(last_lot);
+    """,
+]
+
+LOT_FIELDS = ("lot", "user_id", "username", "amount", "after_commission", "price_fp", "price_direct", "created")
+
+
+class SqliteStorage(BotStorage):
+    """Хранилище в SQLite (WAL). Все запросы выполняются в одном фоновом потоке."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        # Один поток: соединение SQLite не делится между потоками, а запись и так последовательна
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    async def _run(self, fn: Callable, *args) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args))
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, script in enumerate(SQLITE_MIGRATIONS[version:], start=version + 1):
+            conn.executescript(f"BEGIN;{script}\nPRAGMA user_version={number};COMMIT;")
+        self._conn = conn
+
+    async def open(self):
+        await self._run(self._connect)
+        logging.info(f"SQLite: {self.path}, пользователей: {await self.count_users()}")
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+    def _execute(self, sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+        return self._conn.execute(sql, params).fetchall()
+
+    def _add_user(self, user_id: int, username: Optional[str], first_name: Optional[str]):
+        key = username_key(username) if username else None
+        if key is not None:
+            # Username переходит к тому, кого видели с ним последним
+            self._conn.execute(
+                "UPDATE users SET username_key = NULL WHERE username_key = ? AND id != ?",
+                (key, user_id),
+            )
+        # Запись происходит только если пользователь новый, данные действительно
+        # изменились или last_seen устарел больше чем на SEEN_RESOLUTION
+        now = datetime.now()
+        self._conn.execute(
+            """
+            INSERT INTO users (id, username, username_key, first_name, first_seen, last_seen)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                username = COALESCE(excluded.username, username),
+                username_key = COALESCE(excluded.username_key, username_key),
+                first_name = COALESCE(excluded.first_name, first_name),
+                last_seen = excluded.last_seen,
+                active = 1
+            WHERE COALESCE(excluded.username, username) IS NOT username
+               OR COALESCE(excluded.username_key, username_key) IS NOT username_key
+               OR COALESCE(excluded.first_name, first_name) IS NOT first_name
+               OR active = 0
+               OR last_seen IS NULL OR last_seen <= ?
+            """,
+            (user_id, username, key, first_name, now.isoformat(), now.isoformat(),
+             (now - SEEN_RESOLUTION).isoformat()),
+        )
+
+    async def add_user(self, user_id: int, username: str = None, first_name: str = None):
+        await self._run(self._add_user, user_id, username or None, first_name or None)
+
+    async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        rows = await self._run(
+            self._execute,
+            "SELECT id, username, first_name, first_seen FROM users WHERE id = ?",
+            (user_id,),
+        )
+        return dict(rows[0]) if rows else None
+
+    async def get_user_by_username(self, username: str) -> Optional[int]:
+        rows = await self._run(
+            self._execute,
+            "SELECT id FROM users WHERE username_key = ? LIMIT 1",
+            (username_key(username),),
+        )
+        return rows[0]["id"] if rows else None
+
+    async def get_all_users(self) -> list[int]:
+        rows = await self._run(self._execute, "SELECT id FROM users WHERE active = 1")
+        return [row["id"] for row in rows]
+
+    @staticmethod
+    def _audience_where(audience: Audience) -> tuple[str, tuple]:
+        """Условие WHERE для аудитории; каждое условие обслуживается индексом."""
+        clauses, params = [], []
+        if audience.status != "any":
+            clauses.append("active = ?")
+            params.append(int(audience.status == "active"))
+        if audience.new_days is not None:
+            clauses.append("first_seen >= ?")
+            params.append(Audience.cutoff(audience.new_days))
+        if audience.seen_days is not None:
+            clauses.append("last_seen >= ?")
+            params.append(Audience.cutoff(audience.seen_days))
+        if audience.lots and audience.lots_days is not None:
+            clauses.append("last_lot >= ?")
+            params.append(Audience.cutoff(audience.lots_days))
+        elif audience.lots:
+            clauses.append("last_lot IS NOT NULL")
+        elif audience.lots is False:
+            clauses.append("last_lot IS NULL")
+        return " AND ".join(clauses) or "1", tuple(params)
+
+    async def select_users(self, audience: Audience) -> list[int]:
+        where, params = self._audience_where(audience)
+        rows = await self._run(self._execute, f"SELECT id FROM users WHERE {where}", params)
+        return [row["id"] for row in rows]
+
+    async def count_audience(self, audience: Audience) -> int:
+        where, params = self._audience_where(audience)
+        rows = await self._run(self._execute, f"SELECT COUNT(*) FROM users WHERE {where}", params)
+        return rows[0][0]
+
+    async def set_user_active(self, user_id: int, active: bool):
+        await self._run(
+            self._execute, "UPDATE users SET active = ? WHERE id = ?", (int(active), user_id)
+        )
+
+    async def count_users(self) -> int:
+        rows = await self._run(self._execute, "SELECT COUNT(*) FROM users")
+        return rows[0][0]
+
+    async def get_last_request(self, user_id: int) -> Optional[datetime]:
+        rows = await self._run(
+            self._execute, "SELECT last_request FROM users WHERE id = ?", (user_id,)
+        )
+        if rows and rows[0]["last_request"] is not None:
+            return datetime.fromtimestamp(rows[0]["last_request"])
+        return None
+
+    async def set_last_request(self, user_id: int, when: datetime):
+        await self._run(
+            self._execute,
+            """
+            INSERT INTO users (id, first_seen, last_request) VALUES (?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET last_request = excluded.last_request
+            """,
+            (user_id, when.isoformat(), when.timestamp()),
+        )
+
+    def _insert_lot(self, lot: Dict[str, Any]) -> bool:
+        try:
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.execute(
+                    f"INSERT INTO lots ({', '.join(LOT_FIELDS)}) VALUES ({', '.join('?' * len(LOT_FIELDS))})",
+                    tuple(lot.get(field) for field in LOT_FIELDS),
+                )
+                self._conn.execute(
+                    "UPDATE users SET last_lot = ? WHERE id = ?", (lot["created"], lot["user_id"])
+                )
+        except sqlite3.IntegrityError:
+            return False  # номер уже занят
+        return True
+
+    async def add_lot(self, lot: Dict[str, Any]) -> bool:
+        return await self._run(self._insert_lot, lot)
+
+    async def get_lot(self, number: str) -> Optional[Dict[str, Any]]:
+        rows = await self._run(
+            self._execute, f"SELECT {', '.join(LOT_FIELDS)} FROM lots WHERE lot = ?", (number,)
+        )
+        return dict(rows[0]) if rows else None
+
+    async def get_user_lots(self, user_id: int, limit: int = 20) -> tuple[list[Dict[str, Any]], int]:
+        rows = await self._run(
+            self._execute,
+            f"SELECT {', '.join(LOT_FIELDS)} FROM lots WHERE user_id = ? ORDER BY created DESC LIMIT ?",
+            (user_id, limit),
+        )
+        total = await self._run(
+            self._execute, "SELECT COUNT(*) FROM lots WHERE user_id = ?", (user_id,)
+        )
+        return [dict(row) for row in rows], total[0][0]
+
+    def _import_users(self, records: list[Dict[str, Any]]) -> int:
+        rows = [
+            (
+                int(r["id"]),
+                r.get("username"),
+                username_key(r["username"]) if r.get("username") else None,
+                r.get("first_name"),
+                r.get("first_seen") or datetime.now().isoformat(),
+                r.get("last_seen") or r.get("first_seen") or datetime.now().isoformat(),
+                datetime.fromisoformat(r["last_request"]).timestamp() if r.get("last_request") else None,
+                int(r.get("active", True)),
+            )
+            for r in records
+        ]
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                """
+                INSERT INTO users (id, username, username_key, first_name, first_seen, last_seen, last_request, active)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    username = COALESCE(excluded.username, username),
+                    username_key = COALESCE(excluded.username_key, username_key),
+                    first_name = COALESCE(excluded.first_name, first_name),
+                    last_seen = MAX(COALESCE(last_seen, ''), excluded.last_seen),
+                    last_request = COALESCE(excluded.last_request, last_request),
+                    active = excluded.active
+                """,
+                rows,
+            )
+            # Username достаётся тому, кого видели с ним последним (username_seen),
+            # как в индексе JSON-бэкенда: владельцы забирают ключ в этом порядке
+            for user_id, key in username_owners((int(r["id"]), r) for r in records).items():
+                self._conn.execute(
+                    "UPDATE users SET username_key = NULL WHERE username_key = ? AND id != ?",
+                    (key, user_id),
+                )
+        return len(rows)
+
+    async def import_users(self, records: Iterable[Dict[str, Any]]) -> int:
+        """Массово загружает записи пользователей одной транзакцией."""
+        return await self._run(self._import_users, list(records))
+
+    def _import_lots(self, lots: list[Dict[str, Any]]) -> int:
+        with self._conn:
+            self._conn.execute("BEGIN")
+            before = self._conn.total_changes
+            self._conn.executemany(
+                f"INSERT OR IGNORE INTO lots ({', '.join(LOT_FIELDS)}) VALUES ({', '.join('?' * len(LOT_FIELDS))})",
+                [tuple(lot.get(field) for field in LOT_FIELDS) for lot in lots],
+            )
+            imported = self._conn.total_changes - before
+            self._conn.execute(
+                """
+                UPDATE users SET last_lot = (SELECT MAX(created) FROM lots WHERE lots.user_id = users.id)
+                WHERE id IN (SELECT user_id FROM lots)
+                """
+            )
+        return imported
+
+    async def import_lots(self, lots: Iterable[Dict[str, Any]]) -> int:
+        """Массово загружает лоты одной транзакцией и обновляет last_lot пользователей."""
+        return await self._run(self._import_lots, list(lots))
+
+    async def count_lots(self) -> int:
+        rows = await self._run(self._execute, "SELECT COUNT(*) FROM lots")
+        return rows[0][0]
+
+
+async def migrate_users_json(json_path: str, storage: SqliteStorage) -> int:
+    """Переносит пользователей из users.json в SQLite. Возвращает число записей."""
+    users = await asyncio.to_thread(load_users_json, json_path)
+    for uid, record in users.items():
+        record.setdefault("id", uid)
+    return await storage.import_users(users.values())
+
+
+async def migrate_lots_jsonl(lots_path: str, storage: SqliteStorage) -> int:
+    """Переносит журнал лотов в таблицу lots. Пользователей переносить раньше:
+    их last_lot заполняется по перенесённым лотам."""
+    lots = await asyncio.to_thread(load_lots_jsonl, lots_path)
+    return await storage.import_lots(lots)
+
+
+def create_storage(
+    backend: str,
+    users_file: str,
+    sqlite_path: str,
+    flush_interval: float,
+    lots_file: str,
+    users_snapshot: Optional[str] = None,
+) -> BotStorage:
+    """Создаёт хранилище по имени бэкенда (json или sqlite)."""
+    if backend == "json":
+        return JsonStorage(users_file, flush_interval, lots_file, users_snapshot)
+    if backend == "sqlite":
+        return SqliteStorage(sqlite_path)
+    raise ValueError(f"Неизвестный STORAGE_BACKEND: {backend}")
+
+
+# ========== Разовый перенос users.json и lots.jsonl -> SQLite ==========
+# Использование: python storage.py users.json bot.db [lots.jsonl]
+async def _migrate_cli(json_path: str, db_path: str, lots_path: str):
+    storage = SqliteStorage(db_path)
+    await storage.open()
+    try:
+        count = await migrate_users_json(json_path, storage)
+        lots = await migrate_lots_jsonl(lots_path, storage)
+    finally:
+        await storage.close()
+    print(f"Перенесено пользователей: {count}, лотов: {lots}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        print("Использование: python storage.py <users.json> <bot.db> [lots.jsonl]")
+        sys.exit(1)
+    asyncio.run(_migrate_cli(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else "lots.jsonl"))
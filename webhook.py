@@ -0,0 +1,127 @@
+import hmac
+import asyncio
+import logging
+from typing import Optional
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+# ========== Режим webhook ==========
+# Telegram присылает обновления POST-запросами на WEBHOOK_PATH. Запрос проверяется
+# по секретному заголовку, обновление обрабатывается в фоне (не более max_concurrency
+# одновременно), а Telegram сразу получает ответ 200.
+#
+# Локальная проверка (без Telegram, WEBHOOK_URL не задан):
+#   BOT_MODE=webhook PORT=8080 WEBHOOK_SECRET=s python Rubaxskupkabot.py
+#   curl -X POST localhost:8080/webhook -H 'X-Telegram-Bot-Api-Secret-Token: s' \
+#        -H 'Content-Type: application/json' \
+#        -d '{"update_id":1,"message":{"message_id":1,"date":0,"chat":{"id":1,"type":"private"},"text":"/start"}}'
+#   curl localhost:8080/health
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """aiohttp-приложение, принимающее обновления от Telegram."""
+
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        path: str,
+        secret: str,
+        max_concurrency: int = 50,
+    ):
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks: set[asyncio.Task] = set()
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle_update)
+        self.app.router.add_get("/health", self.handle_health)
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token, self.secret):
+            return web.Response(status=401)
+
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logging.warning(f"Webhook: некорректное обновление: {e}")
+            return web.Response(status=400)
+
+        # Если все слоты заняты, запрос ждёт здесь — Telegram сам притормозит доставку
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: Update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            logging.exception(f"Webhook: ошибка обработки обновления {update.update_id}: {e}")
+        finally:
+            self._semaphore.release()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "ok",
+            "in_flight": len(self._tasks),
+            "max_concurrency": self.max_concurrency,
+        })
+
+    async def drain(self, timeout: Optional[float] = None):
+        """Дожидается обработки уже принятых обновлений (не дольше timeout секунд)."""
+        if self._tasks:
+            _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+            if pending:
+                logging.warning(f"Webhook: не дождались обработки {len(pending)} обновлений")
+
+
+async def run_webhook(
+    dp: Dispatcher,
+    bot: Bot,
+    host: str,
+    port: int,
+    path: str,
+    secret: str,
+    base_url: Optional[str],
+    max_concurrency: int,
+    drain_timeout: Optional[float] = None,
+):
+    """Запускает webhook-сервер и работает до отмены задачи."""
+    server = WebhookServer(dp, bot, path=path, secret=secret, max_concurrency=max_concurrency)
+    # Как и при поллинге: хуки startup/shutdown диспетчера (в т.ч. закрытие FSM-хранилища)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    runner = web.AppRunner(server.app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logging.info(f"Webhook-сервер слушает {host}:{port}{path}")
+
+    if base_url:
+        await bot.set_webhook(
+            base_url.rstrip("/") + path,
+            secret_token=secret,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(max(max_concurrency, 1), 100),
+        )
+        logging.info(f"Webhook зарегистрирован: {base_url.rstrip('/')}{path}")
+    else:
+        logging.info("WEBHOOK_URL не задан — webhook в Telegram не регистрируется")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        # Новые запросы больше не принимаем, уже принятые — дорабатываем
+        await site.stop()
+        await server.drain(drain_timeout)
+        await runner.cleanup()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)